@@ -0,0 +1,61 @@
+# coding: utf-8
+"""
+Throughput of AsyncLogtailHandler against the threaded LogtailHandler,
+uploading to a local server with 20ms of latency per request.
+
+    python -m benchmarks.bench_async
+"""
+from __future__ import print_function, unicode_literals
+import asyncio
+import time
+
+from logtail.aio import AsyncLogtailHandler
+from logtail.handler import LogtailHandler
+
+from tests.fake_server import FakeIngestServer
+
+from .common import make_record
+
+EVENTS = 20000
+LATENCY = 0.02
+
+
+def _threaded(url):
+    handler = LogtailHandler(source_token='bench', host=url, buffer_capacity=500, drop_extra_events=False)
+    record = make_record(extra_keys=5)
+    start = time.perf_counter()
+    for _ in range(EVENTS):
+        handler.handle(record)
+    handler.flush()
+    return time.perf_counter() - start
+
+
+def _async(url):
+    handler = AsyncLogtailHandler(source_token='bench', host=url, buffer_capacity=500, max_pending_batches=EVENTS)
+    record = make_record(extra_keys=5)
+
+    async def main():
+        start = time.perf_counter()
+        for i in range(EVENTS):
+            handler.handle(record)
+            if i % 100 == 0:
+                # Let the loop send full batches, as a real service would.
+                await asyncio.sleep(0)
+        await handler.aflush()
+        elapsed = time.perf_counter() - start
+        await handler.uploader.close()
+        return elapsed
+
+    return asyncio.run(main())
+
+
+def main():
+    print('%d events, %dms upload latency' % (EVENTS, LATENCY * 1e3))
+    for name, run in (('threaded', _threaded), ('asyncio', _async)):
+        with FakeIngestServer(latency=LATENCY) as server:
+            elapsed = run(server.url)
+        print('  %-10s %10.0f events/s  %4d requests' % (name, EVENTS / elapsed, server.requests))
+
+
+if __name__ == '__main__':
+    main()
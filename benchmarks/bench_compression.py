@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+Bytes on the wire and CPU time per batch for each compression setting.
+
+    python -m benchmarks.bench_compression
+"""
+from __future__ import print_function, unicode_literals
+import time
+
+from logtail.compat import zstd_compress
+from logtail.frame import create_frame
+from logtail.helpers import LogtailContext
+from logtail.uploader import Uploader
+
+from .common import make_record
+
+BATCH_SIZE = 1000
+SETTINGS = [(None, None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+if zstd_compress is not None:
+    SETTINGS += [('zstd', 1), ('zstd', 3), ('zstd', 10)]
+
+
+class _Capture(object):
+    def post(self, host, data=None, headers=None, timeout=None):
+        self.data = data
+
+
+def _batch(uploader):
+    context = LogtailContext()
+    batch = uploader.new_batch()
+    for i in range(BATCH_SIZE):
+        record = make_record(extra_keys=5, args=(str(i),))
+        batch.append(create_frame(record, record.getMessage(), context, include_extra_attributes=True, serializable=True))
+    return batch
+
+
+def main(rounds=20):
+    print('%d events per batch' % BATCH_SIZE)
+    print('  %-10s %12s %10s %12s' % ('setting', 'bytes', 'ratio', 'cpu/batch'))
+    raw_size = None
+    for compression, level in SETTINGS:
+        uploader = Uploader('bench', 'http://localhost', 1, compression=compression, compression_level=level)
+        uploader.session = capture = _Capture()
+        batch = _batch(uploader)
+        start = time.process_time()
+        for _ in range(rounds):
+            uploader(batch)
+        cpu = (time.process_time() - start) / rounds
+        size = len(capture.data)
+        raw_size = raw_size or size
+        name = '%s:%s' % (compression, level) if compression else 'none'
+        print('  %-10s %12d %9.1fx %10.2f ms' % (name, size, raw_size / float(size), cpu * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# coding: utf-8
+"""
+Per-record cost of building a frame with 1 to 10 nested contexts, with the
+collapsed context cached between log calls and rebuilt for every record as
+it was before.
+
+Also runs requests that each enter their own context from a thread pool and
+from asyncio tasks, comparing the previous context shared by all threads
+with the `contextvars` based one. Leaked frames carry another request's
+context.
+
+    python -m benchmarks.bench_context
+"""
+from __future__ import print_function, unicode_literals
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from logtail.handler import LogtailHandler
+from logtail.helpers import LogtailContext
+
+from .common import make_record, per_call, report
+
+
+class _SharedListContext(object):
+    """ The previous implementation: one stack for all threads and tasks. """
+    def __init__(self):
+        self.extras = []
+
+    def __call__(self, **kwargs):
+        self.extras.append(kwargs)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.extras.pop()
+
+    def exists(self):
+        return bool(self.extras)
+
+    def collapse(self):
+        x = {}
+        for contexts in list(self.extras):
+            for name, data in contexts.items():
+                x.setdefault(name, {}).update(data)
+        return x
+
+
+def _rebuilt(handler, record, context):
+    node = context._top()
+    while node is not None:
+        node._collapsed = None
+        node = node.parent
+    return handler._create_frame(record, context)
+
+
+def _request(handler, record, context, i):
+    with context(request={'id': i}):
+        frame = handler._create_frame(record, context)
+    return frame['context'].get('request', {}).get('id') != i
+
+
+def _thread_pool(handler, record, context, requests=20000, threads=8):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        leaks = sum(pool.map(lambda i: _request(handler, record, context, i), range(requests)))
+    return (time.perf_counter() - start) / requests * 1e6, leaks
+
+
+def _asyncio_tasks(handler, record, context, requests=20000):
+    async def request(i):
+        with context(request={'id': i}):
+            await asyncio.sleep(0)
+            frame = handler._create_frame(record, context)
+        return frame['context'].get('request', {}).get('id') != i
+
+    async def main():
+        return sum(await asyncio.gather(*(request(i) for i in range(requests))))
+
+    start = time.perf_counter()
+    leaks = asyncio.run(main())
+    return (time.perf_counter() - start) / requests * 1e6, leaks
+
+
+def main():
+    handler = LogtailHandler(source_token='bench')
+    record = make_record(extra_keys=0)
+    for depth in (1, 2, 5, 10):
+        context = LogtailContext()
+        with ExitStack() as stack:
+            for level in range(depth):
+                stack.enter_context(context(**{'scope_%d' % level: {'id': level, 'name': 'scope'}}))
+            report('depth=%d' % depth, [
+                ('collapse per record', per_call(lambda: _rebuilt(handler, record, context))),
+                ('cached collapse', per_call(lambda: handler._create_frame(record, context))),
+            ])
+
+    for name, run in (('thread pool', _thread_pool), ('asyncio tasks', _asyncio_tasks)):
+        rows = []
+        for label, context in (('shared list', _SharedListContext()), ('contextvars', LogtailContext())):
+            per_request, leaks = run(handler, record, context)
+            rows.append(('%s us per request' % label, per_request))
+            rows.append(('%s leaked frames' % label, leaks))
+        report(name, rows, unit='')
+
+
+if __name__ == '__main__':
+    main()
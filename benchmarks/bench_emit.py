@@ -0,0 +1,68 @@
+# coding: utf-8
+"""
+Per-record cost of the `LogtailHandler.emit` path.
+
+Compares the previous `json.loads(json.dumps(frame, default=str))` round trip
+against building the serializable frame in a single pass, and reports emit
+latency percentiles with and without `deferred_formatting`.
+
+    python -m benchmarks.bench_emit
+"""
+from __future__ import print_function, unicode_literals
+import json
+
+from logtail.frame import create_frame
+from logtail.handler import LogtailHandler
+from logtail.helpers import LogtailContext
+
+from .common import NullUploader, latencies, make_record, per_call, report
+
+
+def _json_round_trip(record, context):
+    frame = create_frame(record, record.getMessage(), context, include_extra_attributes=True)
+    return json.loads(json.dumps(frame, default=str))
+
+
+def _single_pass(record, context):
+    return create_frame(record, record.getMessage(), context, include_extra_attributes=True, serializable=True)
+
+
+def _emit(extra_keys):
+    handler = LogtailHandler(source_token='bench', buffer_capacity=100000)
+    handler.uploader = NullUploader()
+    record = make_record(extra_keys)
+    per_record = per_call(lambda: handler.emit(record))
+    handler.flush()
+    return per_record
+
+
+def _emit_latencies(extra_keys, deferred_formatting):
+    handler = LogtailHandler(source_token='bench', buffer_capacity=100000, deferred_formatting=deferred_formatting)
+    handler.uploader = NullUploader()
+    record = make_record(extra_keys)
+    p50, p99 = latencies(lambda: handler.emit(record))
+    handler.flush()
+    return p50, p99
+
+
+def main():
+    context = LogtailContext()
+    for extra_keys in (0, 10, 100):
+        record = make_record(extra_keys)
+        report('frame sanitization, %d extra keys' % extra_keys, [
+            ('json round trip', per_call(lambda: _json_round_trip(record, context))),
+            ('single pass', per_call(lambda: _single_pass(record, context))),
+            ('handler.emit', _emit(extra_keys)),
+        ])
+    for extra_keys in (0, 100):
+        rows = []
+        for deferred_formatting in (False, True):
+            p50, p99 = _emit_latencies(extra_keys, deferred_formatting)
+            mode = 'deferred' if deferred_formatting else 'inline'
+            rows.append(('%s emit p50' % mode, p50))
+            rows.append(('%s emit p99' % mode, p99))
+        report('emit latency, %d extra keys' % extra_keys, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# coding: utf-8
+"""
+Per-record cost of `LogtailFormatter.format`, compared with the previous
+implementation calling `json.dumps(frame, default=..., cls=...)` for every
+record, for each available serializer, and when one formatter is shared by
+two handlers (e.g. Better Stack and stdout).
+
+    python -m benchmarks.bench_formatter
+"""
+from __future__ import print_function, unicode_literals
+import json
+import logging
+
+from logtail.compat import orjson, ujson
+from logtail.formatter import LogtailFormatter
+from logtail.frame import create_frame
+from logtail.helpers import LogtailContext
+
+from .common import make_record, per_call, report
+
+
+class _PreviousFormatter(LogtailFormatter):
+    def format(self, record):
+        frame = create_frame(record, record.getMessage(), self.context, include_extra_attributes=True)
+        return json.dumps(frame, default=self.json_default, cls=self.json_encoder)
+
+
+def _once(formatter, record):
+    # A copy of the record, or the formatter would return its last line.
+    return formatter.format(logging.makeLogRecord(record.__dict__))
+
+
+def _twice(formatter, record):
+    # What two handlers with the same formatter do for every record.
+    record = logging.makeLogRecord(record.__dict__)
+    formatter.format(record)
+    formatter.format(record)
+
+
+def main():
+    context = LogtailContext()
+    serializers = [name for name, module in (('orjson', orjson), ('ujson', ujson)) if module is not None]
+    for extra_keys in (0, 10, 100):
+        record = make_record(extra_keys)
+        for json_default in (None, str):
+            previous = _PreviousFormatter(context, json_default)
+            current = LogtailFormatter(context, json_default)
+            rows = [
+                ('previous', per_call(lambda: _once(previous, record))),
+                ('cached encoder', per_call(lambda: _once(current, record))),
+                ('previous, two handlers', per_call(lambda: _twice(previous, record))),
+                ('cached encoder, two handlers', per_call(lambda: _twice(current, record))),
+            ]
+            for serializer in serializers:
+                formatter = LogtailFormatter(context, json_default, serializer=serializer)
+                rows.append((serializer, per_call(lambda: _once(formatter, record))))
+            report('%d extra keys, json_default=%s' % (extra_keys, getattr(json_default, '__name__', None)), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# coding: utf-8
+"""
+Cost of removing circular references from `extra` payloads of growing depth
+and width, compared with the previous implementation that copied the memo set
+for every child.
+
+    python -m benchmarks.bench_frame
+"""
+from __future__ import print_function, unicode_literals
+
+from logtail.frame import _remove_circular_dependencies
+
+from .common import make_extra, per_call, report
+
+
+def _copying_memo(obj, memo=None):
+    if memo is None:
+        memo = set()
+    if isinstance(obj, (str, int, float, bool, type(None))):
+        return obj
+    obj_id = id(obj)
+    if obj_id in memo:
+        return "<omitted circular reference>"
+    memo.add(obj_id)
+    if isinstance(obj, dict):
+        return {key: _copying_memo(value, memo.copy()) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_copying_memo(item, memo.copy()) for item in obj]
+    return obj
+
+
+def main():
+    for width, depth in ((10, 1), (100, 1), (1000, 1), (10, 10), (10, 100), (100, 100)):
+        payload = make_extra(width, depth)
+        number = max(10, 20000 // (width * depth))
+        report('width=%d depth=%d' % (width, depth), [
+            ('memo copy per child', per_call(lambda: _copying_memo(payload), number=number)),
+            ('ancestor path', per_call(lambda: _remove_circular_dependencies(payload), number=number)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
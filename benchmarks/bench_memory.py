@@ -0,0 +1,80 @@
+# coding: utf-8
+"""
+Memory taken by 100k events waiting in the handler's pipe, queued as frames
+(nested dicts), as `CompactEvent`s and encoded with msgpack.
+
+    python -m benchmarks.bench_memory
+"""
+from __future__ import print_function, unicode_literals
+import gc
+import logging
+import tracemalloc
+
+from logtail.handler import LogtailHandler
+from logtail.helpers import LogtailContext
+
+from .common import report
+
+EVENTS = 100000
+
+
+def _queued_bytes(fill):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = fill()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def _records(extra):
+    for i in range(EVENTS):
+        record = logging.LogRecord('bench', logging.INFO, '/srv/app/orders.py', 42, 'Received order id=%s', (i,), None)
+        if extra:
+            record.order = {'id': i, 'total': 12.5}
+        yield record
+
+
+def _fill_handler(extra, **kwargs):
+    context = LogtailContext()
+
+    def fill():
+        handler = LogtailHandler(
+            source_token='bench',
+            buffer_capacity=EVENTS,
+            max_buffer_bytes=0,
+            level_budgets={logging.NOTSET: 1.0},
+            context=context,
+            **kwargs
+        )
+        # Nothing takes the events out of the pipe while measuring.
+        handler.ensure_flush_thread_alive = lambda: None
+        with context(request={'path': '/orders', 'method': 'POST'}):
+            for record in _records(extra):
+                handler.emit(record)
+        assert handler.pipe.qsize() == EVENTS
+        return handler
+    return fill
+
+
+def main():
+    for extra in (False, True):
+        rows = []
+        for name, fill in (
+            ('frames', _fill_handler(extra)),
+            ('compact events', _fill_handler(extra, compact_events=True)),
+            ('encoded events', _fill_handler(extra, encoded_events=True)),
+        ):
+            nbytes = _queued_bytes(fill)
+            rows.append(('%s per event' % name, nbytes / EVENTS))
+            rows.append(('%s per 100k events (MB)' % name, nbytes / 1e6))
+        report('queued events %s an extra dict' % ('with' if extra else 'without'), rows, unit='')
+
+
+if __name__ == '__main__':
+    main()
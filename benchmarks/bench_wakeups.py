@@ -0,0 +1,66 @@
+# coding: utf-8
+"""
+Idle wakeups of a flush worker and `handler.flush()` latency, with a pipe
+that is polled every `check_interval` (plain queue.Queue, as before) and one
+that wakes the worker up on demand (`logtail.pipe.Pipe`).
+
+    python -m benchmarks.bench_wakeups
+"""
+from __future__ import print_function, unicode_literals
+import time
+
+from logtail.compat import queue
+from logtail.handler import LogtailHandler
+from logtail.pipe import Pipe
+
+from .common import NullUploader, make_record, report
+
+IDLE_SECONDS = 3
+
+
+def _handler(pipe_class):
+    handler = LogtailHandler(source_token='bench')
+    handler.pipe = pipe_class(maxsize=handler.buffer_capacity)
+    handler.uploader = NullUploader()
+    wakeups = [0]
+    get = handler.pipe.get
+
+    def counting_get(*args, **kwargs):
+        try:
+            return get(*args, **kwargs)
+        finally:
+            wakeups[0] += 1
+    handler.pipe.get = counting_get
+    return handler, wakeups
+
+
+def main():
+    record = make_record()
+    for name, pipe_class in (('polled queue', queue.Queue), ('wakeable pipe', Pipe)):
+        handler, wakeups = _handler(pipe_class)
+        handler.handle(record)
+        handler.flush()
+
+        wakeups[0] = 0
+        time.sleep(IDLE_SECONDS)
+        idle = wakeups[0] / float(IDLE_SECONDS)
+
+        latencies = []
+        for _ in range(20):
+            handler.handle(record)
+            # Let the worker pick the event up and go back to waiting.
+            time.sleep(0.01)
+            start = time.perf_counter()
+            handler.flush()
+            latencies.append((time.perf_counter() - start) * 1e6)
+        latencies.sort()
+
+        report('%s, idle' % name, [('worker wakeups', idle)], unit='/s')
+        report('%s, handler.flush()' % name, [
+            ('flush p50', latencies[len(latencies) // 2]),
+            ('flush max', latencies[-1]),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import logging
+import time
+import timeit
+
+from logtail.uploader import Uploader
+
+
+class NullResponse(object):
+    status_code = 202
+
+
+class NullUploader(Uploader):
+    """ Encodes every batch but accepts it without doing any network I/O. """
+    def __init__(self, **kwargs):
+        Uploader.__init__(self, 'bench', 'http://127.0.0.1', 30, **kwargs)
+        self.batches = 0
+        self.events = 0
+
+    def __call__(self, frame):
+        self.payload(frame)
+        self.batches += 1
+        self.events += len(frame)
+        return NullResponse()
+
+
+def make_record(extra_keys=10, depth=1, msg='Received order id=%s', args=('1234',)):
+    record = logging.LogRecord('bench', logging.INFO, '/srv/app/orders.py', 42, msg, args, None)
+    record.__dict__.update(make_extra(extra_keys, depth))
+    return record
+
+
+def make_extra(width, depth):
+    node = {'key_%d' % i: 'value %d' % i for i in range(width)}
+    for level in range(depth - 1):
+        node = {'level_%d' % level: node, 'id': level}
+    return {'request': {'path': '/orders', 'method': 'POST'}, 'order': node}
+
+
+def per_call(fn, number=10000, repeat=5):
+    """ Best-of-`repeat` time of a single `fn()` call, in microseconds. """
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+
+def latencies(fn, number=20000):
+    """ p50/p99 of individual `fn()` calls, in microseconds. """
+    samples = []
+    clock = time.perf_counter
+    for _ in range(number):
+        start = clock()
+        fn()
+        samples.append(clock() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1e6, samples[int(len(samples) * 0.99)] * 1e6
+
+
+def report(title, rows, unit='us'):
+    print(title)
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        print('  %s  %10.2f %s' % (name.ljust(width), value, unit))
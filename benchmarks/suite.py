@@ -0,0 +1,318 @@
+# coding: utf-8
+"""
+Reproducible benchmarks of the whole emit -> frame -> upload pipeline, with
+results written as JSON so runs can be compared across commits.
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare results.json
+
+`--compare` reports the change of every result against an earlier run and
+exits with status 1 when any got worse by more than `--threshold`. `--quick`
+runs fewer iterations, and `--filter` only runs benchmarks whose name
+contains the given text. The end-to-end benchmarks upload to a local server
+whose latency and error rate are set with `--latency` and `--error-rate`.
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import logtail
+from logtail.formatter import SERIALIZERS, LogtailFormatter
+from logtail.frame import create_frame
+from logtail.handler import DEFAULT_BUFFER_CAPACITY, DEFAULT_FLUSH_INTERVAL, LogtailHandler
+from logtail.helpers import LogtailContext
+from logtail.uploader import Uploader
+
+from tests.fake_server import FakeIngestServer
+
+from .common import NullUploader, make_record, per_call
+
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_LATENCY = 0.02
+DEFAULT_ERROR_RATE = 0.05
+BENCHMARKS = []
+
+
+def benchmark(name, unit, better='lower'):
+    def register(fn):
+        BENCHMARKS.append((name, unit, better, fn))
+        return fn
+    return register
+
+
+class Settings(object):
+    def __init__(self, quick=False, latency=DEFAULT_LATENCY, error_rate=DEFAULT_ERROR_RATE):
+        self.quick = quick
+        self.latency = latency
+        self.error_rate = error_rate
+        # Iterations of micro benchmarks and events of the threaded ones.
+        self.number = 2000 if quick else 10000
+        self.repeat = 3 if quick else 5
+        self.events = 20000 if quick else 100000
+        self.seconds = 2 if quick else 5
+
+
+def _format_benchmark(extra_keys, serializer):
+    try:
+        formatter = LogtailFormatter(serializer=serializer)
+    except ImportError:
+        return
+
+    @benchmark('formatter.format[extra=%d,%s]' % (extra_keys, serializer), 'us')
+    def format(settings):
+        record = make_record(extra_keys)
+        # A copy of the record every time, as the formatter remembers the line
+        # of the last one.
+        return per_call(
+            lambda: formatter.format(logging.makeLogRecord(record.__dict__)),
+            number=settings.number, repeat=settings.repeat,
+        )
+
+
+def _frame_benchmarks(extra_keys):
+    @benchmark('create_frame[extra=%d]' % extra_keys, 'us')
+    def frame(settings):
+        record = make_record(extra_keys)
+        context = LogtailContext()
+        return per_call(
+            lambda: create_frame(record, record.getMessage(), context, include_extra_attributes=True),
+            number=settings.number, repeat=settings.repeat,
+        )
+
+    for serializer in SERIALIZERS:
+        _format_benchmark(extra_keys, serializer)
+
+    @benchmark('uploader.encode[extra=%d]' % extra_keys, 'us')
+    def encode(settings):
+        uploader = Uploader('bench', 'http://127.0.0.1', 30)
+        record = make_record(extra_keys)
+        frame = create_frame(record, record.getMessage(), LogtailContext(), include_extra_attributes=True)
+        return per_call(lambda: uploader.encode(frame), number=settings.number, repeat=settings.repeat)
+
+
+for _extra_keys in (0, 10, 100):
+    _frame_benchmarks(_extra_keys)
+
+
+@benchmark('uploader.payload[batch=1000]', 'us')
+def payload(settings):
+    uploader = Uploader('bench', 'http://127.0.0.1', 30)
+    record = make_record(10)
+    frame = create_frame(record, record.getMessage(), LogtailContext(), include_extra_attributes=True)
+    batch = [frame] * 1000
+    return per_call(lambda: uploader.payload(batch), number=max(settings.number // 100, 10), repeat=settings.repeat)
+
+
+def _emit_benchmark(threads):
+    @benchmark('handler.emit[threads=%d]' % threads, 'events/s', better='higher')
+    def emit(settings):
+        handler = LogtailHandler(
+            source_token='bench',
+            buffer_capacity=settings.events,
+            max_buffer_bytes=0,
+            level_budgets={logging.NOTSET: 1.0},
+            drop_extra_events=False,
+        )
+        handler.uploader = NullUploader()
+        record = make_record(10)
+        per_thread = settings.events // threads
+        start_line = threading.Barrier(threads + 1)
+
+        def run():
+            start_line.wait()
+            for _ in range(per_thread):
+                handler.handle(record)
+
+        workers = [threading.Thread(target=run) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        start_line.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        handler.flush()
+        return per_thread * threads / elapsed
+
+
+for _threads in (1, 8, 64):
+    _emit_benchmark(_threads)
+
+
+def _end_to_end(settings, server, rate, **kwargs):
+    """
+    Emits `rate` events per second for `settings.seconds` and flushes.
+    Returns the elapsed time.
+    """
+    handler = LogtailHandler(
+        source_token='bench',
+        host=server.url,
+        drop_extra_events=False,
+        retry_schedule=(0.05, 0.1, 0.2),
+        retry_jitter=0,
+        **kwargs
+    )
+    record = make_record(10)
+    events = int(rate * settings.seconds)
+    start = time.perf_counter()
+    for i in range(events):
+        # Paced to `rate`, sleeping only once ahead of schedule.
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0.001:
+            time.sleep(delay)
+        record.created = time.time()
+        handler.handle(record)
+    handler.flush()
+    return time.perf_counter() - start
+
+
+def _percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else 0.0
+
+
+def _end_to_end_benchmark(label, rate, error_rate, latency=None, lag_bound=None, **kwargs):
+    metrics = {}
+
+    def run(settings):
+        if 'server' not in metrics:
+            latency_ = latency if latency is not None else settings.latency
+            if lag_bound is not None:
+                kwargs['flush_interval'] = lag_bound + latency_
+            rate_ = error_rate if error_rate is not None else settings.error_rate
+            with FakeIngestServer(latency=latency_, error_rate=rate_, track_lag=True) as server:
+                elapsed = _end_to_end(settings, server, rate, **kwargs)
+            metrics['server'] = server
+            metrics['elapsed'] = elapsed
+        return metrics['server'], metrics['elapsed']
+
+    @benchmark('e2e[%s].throughput' % label, 'events/s', better='higher')
+    def throughput(settings):
+        server, elapsed = run(settings)
+        return len(server.events) / elapsed
+
+    @benchmark('e2e[%s].requests' % label, 'requests')
+    def requests(settings):
+        return run(settings)[0].requests
+
+    @benchmark('e2e[%s].lag_p50' % label, 'ms')
+    def lag_p50(settings):
+        return _percentile(run(settings)[0].lags, 0.5) * 1e3
+
+    @benchmark('e2e[%s].lag_p99' % label, 'ms')
+    def lag_p99(settings):
+        return _percentile(run(settings)[0].lags, 0.99) * 1e3
+
+
+# A quiet service whose batches are sent by the flush interval, busier ones
+# filling whole batches, one against an endpoint too slow for batches of
+# `buffer_capacity` events, and one against a failing endpoint. The static
+# settings deliver events within the time it takes to fill a batch (or
+# `flush_interval`) plus an upload, and the adaptive variants are given that
+# as their bound, so they can be compared at about the same lag.
+for _label, _rate, _error_rate, _latency in (
+    ('steady', 200, 0.0, None),
+    ('moderate', 3000, 0.0, None),
+    ('burst', 20000, 0.0, None),
+    ('slow', 10000, 0.0, 0.25),
+    ('errors', 5000, None, None),
+):
+    _end_to_end_benchmark(_label, _rate, _error_rate, _latency)
+    _end_to_end_benchmark(_label + '+adaptive', _rate, _error_rate, _latency, adaptive=True,
+                          lag_bound=min(DEFAULT_FLUSH_INTERVAL, DEFAULT_BUFFER_CAPACITY / _rate))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(settings, name_filter=None):
+    results = {}
+    for name, unit, better, fn in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        value = fn(settings)
+        results[name] = {'value': value, 'unit': unit, 'better': better}
+        print('  %-36s %12.2f %s' % (name, value, unit))
+    return {
+        'meta': {
+            'logtail': logtail.__version__,
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'quick': settings.quick,
+            'latency': settings.latency,
+            'error_rate': settings.error_rate,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """ Prints the change of every result and returns the names of regressions. """
+    regressions = []
+    print('compared with %s (%s)' % (baseline['meta'].get('revision'), baseline['meta'].get('timestamp')))
+    for setting in ('quick', 'latency', 'error_rate', 'python'):
+        if baseline['meta'].get(setting) != current['meta'].get(setting):
+            print('  warning: %s differs (%s -> %s)' % (
+                setting, baseline['meta'].get(setting), current['meta'].get(setting),
+            ))
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None or not before['value']:
+            continue
+        change = result['value'] / before['value'] - 1
+        worse = -change if result['better'] == 'higher' else change
+        flag = ''
+        if worse > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('  %-36s %12.2f -> %12.2f %-9s %+7.1f%%%s' % (
+            name, before['value'], result['value'], result['unit'], change * 100, flag,
+        ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the logtail pipeline.')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with results from this JSON file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative change counted as a regression (default: %(default)s)')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='run fewer iterations')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help='seconds the local server takes per request (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_ERROR_RATE,
+                        help='fraction of requests the local server fails (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    settings = Settings(quick=args.quick, latency=args.latency, error_rate=args.error_rate)
+    current = run(settings, args.filter)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,9 @@
 from __future__ import print_function, unicode_literals
 
 from .handler import LogtailHandler
+from .aio import AsyncLogtailHandler
+from .shipper import Shipper
+from .sampling import Sampler
 from .helpers import LogtailContext, DEFAULT_CONTEXT
 from .formatter import LogtailFormatter
 
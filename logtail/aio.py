@@ -0,0 +1,294 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from .compat import aiohttp
+from .flusher import RETRY_SCHEDULE, _append, _should_retry
+from .frame import create_frame
+from .handler import (
+    DEFAULT_HOST, DEFAULT_BUFFER_CAPACITY, DEFAULT_FLUSH_INTERVAL, DEFAULT_RAISE_EXCEPTIONS,
+    DEFAULT_INCLUDE_EXTRA_ATTRIBUTES, DEFAULT_TIMEOUT, DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_LEVEL,
+    DEFAULT_BATCH_BYTES, DEFAULT_MAX_EVENT_BYTES, _host_url,
+)
+from .helpers import DEFAULT_CONTEXT
+from .uploader import Fake500, Uploader
+
+DEFAULT_MAX_PENDING_BATCHES = 10
+
+
+class AsyncUploader(Uploader):
+    """ Uploader posting batches with aiohttp; must be awaited on one event loop. """
+    def _create_session(self):
+        if aiohttp is None:
+            raise ImportError('AsyncUploader requires the aiohttp package')
+        # The client session is bound to the event loop, so it is created on
+        # first use from inside of it.
+        return None
+
+    async def __call__(self, frame):
+        data = self.payload(frame)
+        try:
+            if self.session is None:
+                self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+            async with self.session.post(self.host, data=data, headers=self.headers) as response:
+                # Reading the body lets the connection go back to the pool.
+                await response.read()
+                return _Response(response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return Fake500(e)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class _Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class AsyncLogtailHandler(logging.Handler):
+    """
+    LogtailHandler variant batching and uploading on an asyncio event loop.
+
+    Uses the loop running when the first record is emitted (or `loop`), or a
+    dedicated loop thread if there is none. Events are never blocked on: once
+    `max_pending_batches` full batches are waiting, extra events are dropped.
+    """
+    def __init__(self,
+                 source_token,
+                 host=DEFAULT_HOST,
+                 buffer_capacity=DEFAULT_BUFFER_CAPACITY,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 raise_exceptions=DEFAULT_RAISE_EXCEPTIONS,
+                 include_extra_attributes=DEFAULT_INCLUDE_EXTRA_ATTRIBUTES,
+                 context=DEFAULT_CONTEXT,
+                 timeout=DEFAULT_TIMEOUT,
+                 compression=DEFAULT_COMPRESSION,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 retry_schedule=RETRY_SCHEDULE,
+                 max_pending_batches=DEFAULT_MAX_PENDING_BATCHES,
+                 batch_bytes=DEFAULT_BATCH_BYTES,
+                 max_event_bytes=DEFAULT_MAX_EVENT_BYTES,
+                 loop=None,
+                 level=logging.NOTSET):
+        super(AsyncLogtailHandler, self).__init__(level=level)
+        self.source_token = source_token
+        self.host = _host_url(host)
+        self.context = context
+        self.uploader = AsyncUploader(
+            self.source_token,
+            self.host,
+            timeout,
+            compression=compression,
+            compression_level=compression_level,
+            max_event_bytes=max_event_bytes,
+        )
+        self.buffer_capacity = buffer_capacity
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.raise_exceptions = raise_exceptions
+        self.include_extra_attributes = include_extra_attributes
+        self.retry_schedule = tuple(retry_schedule)
+        self.max_pending = max_pending_batches * buffer_capacity
+        self.loop = loop
+        self.pending = deque()
+        self.dropcount = 0
+        self._flush_task = None
+        self._loop_thread = None
+        self._wakeup = None
+        self._in_flight = set()
+        # Batches whose upload was cancelled by the loop shutting down.
+        self._unsent = []
+        self._lock = threading.Lock()
+
+    def ensure_flush_task_running(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+
+        with self._lock:
+            if self._flush_task is not None and not self._flush_task.done():
+                return
+            if self.loop is None or self.loop.is_closed():
+                try:
+                    self.loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    self.loop = self._start_loop_thread()
+            self._flush_task = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+
+    def emit(self, record):
+        try:
+            self.ensure_flush_task_running()
+
+            message = self.format(record)
+            frame = create_frame(
+                record,
+                message,
+                self.context,
+                include_extra_attributes=self.include_extra_attributes,
+                serializable=True,
+            )
+            if len(self.pending) >= self.max_pending:
+                self.dropcount += 1
+                return
+            self.pending.append(frame)
+            if len(self.pending) == self.buffer_capacity:
+                self._wake()
+        except Exception as e:
+            if self.raise_exceptions:
+                raise e
+
+    async def aflush(self):
+        if self.loop is None:
+            return
+        if self.loop.is_closed() or not self.loop.is_running():
+            await self._drain()
+        elif asyncio.get_running_loop() is self.loop:
+            await self._flush()
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._flush(), self.loop))
+
+    def flush(self):
+        # Blocks until everything is sent unless called from the event loop
+        # itself, where the flush can only be scheduled; use `aflush` there.
+        if self.loop is None:
+            return
+        if self.loop.is_closed() or not self.loop.is_running():
+            # Typically the loop of `asyncio.run`, which has returned.
+            self._drain_on_thread()
+            return
+        future = asyncio.run_coroutine_threadsafe(self._flush(), self.loop)
+        if not self._on_loop():
+            future.result()
+
+    def close(self):
+        try:
+            if self._loop_thread is not None and self.loop.is_running():
+                self._flush_task.cancel()
+                asyncio.run_coroutine_threadsafe(self.uploader.close(), self.loop).result()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._loop_thread.join()
+                self._loop_thread = None
+            else:
+                self.flush()
+        finally:
+            super(AsyncLogtailHandler, self).close()
+
+    def _start_loop_thread(self):
+        loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=loop.run_forever, name='logtail-asyncio')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        return loop
+
+    def _on_loop(self):
+        # Whether this is the loop's own thread, where waiting on it would
+        # block it for good. Compares loops rather than threads, since the
+        # flush task may not have started yet.
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _wake(self):
+        if self._wakeup is None:
+            return
+        if self._on_loop():
+            self._wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        # Same batching as `FlushWorker.step`: a batch is sent once it holds
+        # `buffer_capacity` events or `flush_interval` seconds have passed, and
+        # batches are split at `batch_bytes`.
+        try:
+            while True:
+                if len(self.pending) < self.buffer_capacity:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+                self._send_pending()
+        except asyncio.CancelledError:
+            # The loop is shutting down, e.g. at the end of `asyncio.run`: its
+            # connections can only be closed while it still runs.
+            await self.uploader.close()
+            raise
+
+    def _send_pending(self):
+        for batch in self._take_batches():
+            task = asyncio.ensure_future(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def _take_batches(self):
+        while self.pending:
+            batch = self.uploader.new_batch()
+            while self.pending and len(batch) < self.buffer_capacity and getattr(batch, 'nbytes', 0) < self.batch_bytes:
+                _append(batch, self.pending.popleft())
+            yield batch
+
+    async def _send(self, batch):
+        # Batches are sent concurrently, so waiting for a retry only delays
+        # the batch that failed.
+        try:
+            for delay in self.retry_schedule + (None, ):
+                response = await self.uploader(batch)
+                if not _should_retry(response.status_code):
+                    break
+                if delay is not None:
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # The loop is shutting down, e.g. at the end of `asyncio.run`;
+            # the batch is sent again by the next flush, so it is delivered
+            # twice if the server got it already, as after a timeout.
+            self._unsent.append(batch)
+            raise
+
+        if response.status_code == 500 and getattr(response, "exception", None) is not None:
+            print('Failed to send logs to Better Stack after {} retries: {}'.format(len(self.retry_schedule), response.exception))
+
+    async def _flush(self):
+        self._send_pending()
+        while self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def _drain(self):
+        """
+        Sends the events left behind by a loop that is no longer running, on
+        the current loop, with a session of its own.
+        """
+        if self.loop.is_closed():
+            # Whatever was bound to the old loop went with it; the next
+            # record starts over on a running loop.
+            self.loop = None
+            self._flush_task = None
+            self._wakeup = None
+            self._in_flight = set()
+            session = None
+        else:
+            session = self.uploader.session
+        self.uploader.session = None
+        try:
+            unsent, self._unsent = self._unsent, []
+            batches = unsent + list(self._take_batches())
+            if batches:
+                await asyncio.gather(*(self._send(batch) for batch in batches), return_exceptions=True)
+        finally:
+            await self.uploader.close()
+            self.uploader.session = session
+
+    def _drain_on_thread(self):
+        if not self.pending and not self._unsent:
+            return
+        # A thread of its own, as this one may be running another loop.
+        thread = threading.Thread(target=asyncio.run, args=(self._drain(),), name='logtail-drain')
+        thread.start()
+        thread.join()
@@ -5,3 +5,41 @@ try:
     import queue
 except ImportError:
     import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # Python 3.14+
+    from compression import zstd
+    zstd_compress = zstd.compress
+except ImportError:
+    try:
+        import zstandard
+
+        def zstd_compress(data, level=None):
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    except ImportError:
+        zstd_compress = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
@@ -1,28 +1,83 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
 
+import random
 import threading
 import time
+import weakref
+
+import msgpack
 
 from .compat import queue
+from .frame import _isoformat
 
 RETRY_SCHEDULE = (1, 10, 60)  # seconds
+DEFAULT_RETRY_JITTER = 0.1  # fraction of each delay
+DEFAULT_MAX_RETRY_BYTES = 16 * 1024 * 1024
+DEFAULT_COALESCE_WINDOW = 1  # seconds
+DEFAULT_MIN_FLUSH_INTERVAL = 0.05  # seconds
+DEFAULT_ADAPTIVE_SMOOTHING = 0.3
 
 
 class FlushWorker(threading.Thread):
-    def __init__(self, upload, pipe, buffer_capacity, flush_interval, check_interval):
+    def __init__(self, upload, pipe, buffer_capacity, flush_interval, check_interval, prepare=None, new_batch=list,
+                 retry_schedule=RETRY_SCHEDULE, retry_jitter=DEFAULT_RETRY_JITTER, max_retry_bytes=DEFAULT_MAX_RETRY_BYTES,
+                 spill=None, batch_bytes=None, encoded=False, coalesce=None,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW, stats=None, warm_up=None, adaptive=None):
         threading.Thread.__init__(self)
         self.parent_thread = threading.current_thread()
         self.upload = upload
         self.pipe = pipe
         self.buffer_capacity = buffer_capacity
+        # Target payload size: a batch is sent once its encoded events add up
+        # to this many bytes, even if it holds fewer than `buffer_capacity`.
+        self.batch_bytes = batch_bytes
         self.flush_interval = flush_interval
         self.check_interval = check_interval
+        # Optional callable turning queued entries into frames on this thread;
+        # returning None discards the entry.
+        self.prepare = prepare
+        # Creates the container events are collected in; `Uploader.new_batch`
+        # encodes them as they are dequeued instead of all at once when sending.
+        self.new_batch = new_batch
+        # Whether queued entries are events already encoded with msgpack.
+        self._append = _append_encoded if encoded else _append
+        self.retry_schedule = tuple(retry_schedule)
+        self.retry_jitter = retry_jitter
+        self.max_retry_bytes = max_retry_bytes
+        # Batches waiting for their next attempt, oldest first. They are sent
+        # from `step` once due, so a failing batch never blocks fresh ones.
+        self._retries = []
+        self._retry_bytes = 0
+        # Optional `SpillQueue` holding events that did not fit in memory.
+        self.spill = spill
+        # Optional callable returning a `(key, created)` pair for entries that
+        # may be merged with the repeats of the same key that are taken out
+        # of the pipe within `coalesce_window` seconds, or None. Merged events
+        # are sent once, with `repeat_count`, `first_dt` and `last_dt` added.
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self._held = {}
+        # Optional `Stats` updated with the outcome of every upload.
+        self.stats = stats
+        # Optional callable opening the uploader's connection before the
+        # first batch is ready.
+        self.warm_up = warm_up
+        # Optional `AdaptiveBatching` replacing `buffer_capacity` and
+        # `flush_interval` with limits tuned from the observed traffic.
+        self.adaptive = adaptive
         self.should_run = True
         self._flushing = False
-        self._clean = True
+        # Pipes that can be woken up let the worker block for the whole
+        # `flush_interval`; flush requests and interpreter shutdown wake it up.
+        self._wakeable = hasattr(pipe, 'wake')
+        self._step_done = threading.Condition()
+        if self._wakeable:
+            _wake_at_exit(self)
 
     def run(self):
+        if self.warm_up is not None:
+            self.warm_up()
         while self.should_run:
             self.step()
 
@@ -38,60 +93,329 @@ class FlushWorker(threading.Thread):
 
     def step(self):
         last_flush = time.time()
-        time_remaining = _initial_time_remaining(self.flush_interval)
-        frame = []
-        self._clean = True
+        if self.adaptive is not None:
+            capacity, flush_interval = self.adaptive.update()
+        else:
+            capacity, flush_interval = self.buffer_capacity, self.flush_interval
+        time_remaining = _initial_time_remaining(flush_interval)
+        frame = self.new_batch()
+        # Receipts of the spilled events in the batch, acknowledged once it
+        # is done with.
+        receipts = []
 
         # If the parent thread has exited but there are still outstanding
         # events, attempt to send them before exiting.
         shutdown = not self._is_parent_alive()
 
         # Fill phase: take events out of the queue and group them for sending.
-        # Takes up to `buffer_capacity` events out of the queue and groups them
-        # for sending; may send fewer than `buffer_capacity` events if
+        # Takes up to `buffer_capacity` events (or `batch_bytes` bytes) out of
+        # the queue and groups them for sending; may send fewer events if
         # `flush_interval` seconds have passed without sending any events.
-        while len(frame) < self.buffer_capacity and time_remaining > 0:
+        while not self._is_full(frame, capacity) and time_remaining > 0:
+            if self._flushing and not self._retries and self.pipe.empty():
+                break
             try:
-                # Blocks for up to `check_interval` seconds for each item to prevent
-                # spinning and burning CPU unnecessarily. Could block for the
-                # entire amount of `time_remaining` but then in the case that
-                # the parent thread has exited, that entire amount of time
-                # would be waited before this child worker thread exits.
-                entry = self.pipe.get(block=(not shutdown), timeout=self.check_interval)
-                self._clean = False
-                frame.append(entry)
-                self.pipe.task_done()
+                # Pipes that can't be woken up are polled every `check_interval`
+                # seconds, as otherwise flush requests or the parent thread
+                # exiting would only be noticed after `time_remaining`.
+                timeout = time_remaining if self._wakeable else self.check_interval
+                spilled = self._get_spilled(shutdown)
+                if spilled is not None:
+                    data, receipt = spilled
+                    _append_encoded(frame, data)
+                    receipts.append(receipt)
+                else:
+                    entry = self.pipe.get(block=(not shutdown), timeout=timeout)
+                    self._add(frame, entry)
+                    self.pipe.task_done()
             except queue.Empty:
-                if shutdown or self._flushing:
+                if shutdown or self._flushing or not self.should_run:
                     break
             shutdown = not self._is_parent_alive()
-            time_remaining = _calculate_time_remaining(last_flush, self.flush_interval)
+            time_remaining = _calculate_time_remaining(last_flush, flush_interval)
+        self._release_held(frame)
+        if self.adaptive is not None:
+            self.adaptive.observe_events(len(frame), behind=self._is_full(frame, capacity) and not self.pipe.empty())
 
         # Send phase: takes the outstanding events (up to `buffer_capacity`
         # count) and sends them to the Better Stack endpoint all at once. If the
-        # request fails in a way that can be retried, it is retried with an
-        # exponential backoff in between attempts.
+        # request fails in a way that can be retried, the batch is held back
+        # and retried by a later step once its backoff delay has passed.
         if frame:
-            response = None
-            for delay in RETRY_SCHEDULE + (None, ):
-                response = self.upload(frame)
-                if not _should_retry(response.status_code):
-                    break
-                if delay is not None:
-                    time.sleep(delay)
-
-            if response.status_code == 500 and getattr(response, "exception") != None:
-                print('Failed to send logs to Better Stack after {} retries: {}'.format(len(RETRY_SCHEDULE), response.exception))
+            self._send(frame, receipts=receipts)
+        self._send_due_retries()
 
-        self._clean = True
+        with self._step_done:
+            if self._flushing and not self._retries and self.pipe.empty():
+                self._flushing = False
+            self._step_done.notify_all()
         if shutdown and self.pipe.empty():
-            self.should_run = False
+            if self._retries:
+                # Nothing else left to do, so wait for the next retry instead
+                # of spinning until it is due.
+                time.sleep(max(self._retries[0].deadline - time.time(), 0))
+            else:
+                self.should_run = False
+
+    def _add(self, frame, entry):
+        if self.coalesce is not None:
+            found = self.coalesce(entry)
+            if found is not None:
+                self._hold(frame, entry, *found)
+                return
+        self._add_prepared(frame, entry)
+
+    def _add_prepared(self, frame, entry, repeats=None):
+        if self.prepare is not None:
+            entry = self.prepare(entry)
+        if entry is None:
+            return
+        if repeats is not None and repeats.count > 1:
+            entry['repeat_count'] = repeats.count
+            entry['first_dt'] = _isoformat(repeats.first)
+            entry['last_dt'] = _isoformat(repeats.last)
+        self._append(frame, entry)
+
+    def _hold(self, frame, entry, key, created):
+        now = time.time()
+        repeats = self._held.get(key)
+        if repeats is not None and now - repeats.since >= self.coalesce_window:
+            del self._held[key]
+            self._add_prepared(frame, repeats.entry, repeats)
+            repeats = None
+        if repeats is None:
+            self._held[key] = _Repeats(entry, created, now)
+        else:
+            repeats.count += 1
+            repeats.last = created
+
+    def _release_held(self, frame):
+        held, self._held = self._held, {}
+        for repeats in held.values():
+            self._add_prepared(frame, repeats.entry, repeats)
+
+    def _is_full(self, frame, capacity):
+        # Events held back for coalescing take a place in the batch too.
+        if len(frame) + len(self._held) >= capacity:
+            return True
+        # Only uploader batches track their encoded size.
+        return self.batch_bytes is not None and getattr(frame, 'nbytes', 0) >= self.batch_bytes
 
     def flush(self):
-        self._flushing = True
-        while not self._clean or not self.pipe.empty():
-            time.sleep(self.check_interval)
-        self._flushing = False
+        # The worker clears `_flushing` at the end of the first step that
+        # leaves nothing behind in the pipe or waiting to be retried.
+        with self._step_done:
+            self._flushing = True
+            while self._flushing and self.is_alive():
+                # Repeated every `check_interval` in case the worker only
+                # started waiting on the pipe after the previous wakeup.
+                if self._wakeable:
+                    self.pipe.wake()
+                self._step_done.wait(self.check_interval)
+
+    def _send(self, frame, retry=None, receipts=()):
+        attempt = retry.attempt if retry else 0
+        start = time.perf_counter()
+        response = self.upload(frame)
+        seconds = time.perf_counter() - start
+        if self.stats is not None:
+            self.stats.record_upload(
+                frame, response.status_code, seconds,
+                nbytes=_payload_bytes(self.upload), error=getattr(response, 'exception', None),
+            )
+        if self.adaptive is not None:
+            self.adaptive.observe_upload(seconds)
+        if _should_retry(response.status_code) and attempt < len(self.retry_schedule):
+            self._hold_for_retry(retry or _PendingRetry(frame, receipts))
+            return
+        if response.status_code == 500 and getattr(response, "exception") != None:
+            print('Failed to send logs to Better Stack after {} retries: {}'.format(attempt, response.exception))
+        # Sent, or given up on: either way its spilled events are not
+        # replayed. Until then they are, should the process die.
+        self._ack_spilled(retry.receipts if retry else receipts)
+
+    def _ack_spilled(self, receipts):
+        if receipts:
+            self.spill.ack(receipts)
+
+    def _hold_for_retry(self, retry):
+        delay = self.retry_schedule[retry.attempt]
+        delay *= 1 + random.uniform(-self.retry_jitter, self.retry_jitter)
+        retry.attempt += 1
+        retry.deadline = time.time() + delay
+        if self.stats is not None:
+            self.stats.retries += 1
+        self._retries.append(retry)
+        self._retries.sort(key=lambda r: r.deadline)
+        self._retry_bytes += retry.nbytes
+
+        # Move the oldest batches to disk, or drop them, once the retry area
+        # is over its cap.
+        while self._retry_bytes > self.max_retry_bytes and len(self._retries) > 1:
+            dropped = min(self._retries, key=lambda r: r.created)
+            self._retries.remove(dropped)
+            self._retry_bytes -= dropped.nbytes
+            if self.spill is not None:
+                for data in _encoded_events(dropped.frame):
+                    self.spill.put(data)
+                # Written again above.
+                self._ack_spilled(dropped.receipts)
+            else:
+                print('Dropping {} logs waiting to be resent to Better Stack: retry buffer is full'.format(len(dropped.frame)))
+                if self.stats is not None:
+                    self.stats.retry_dropped += len(dropped.frame)
+
+    def _get_spilled(self, shutdown):
+        # Spilled events are older than the ones in the pipe, so they go
+        # first. They are left on disk while uploads are failing, and when
+        # shutting down, as they are replayed by the next worker anyway.
+        if self.spill is None or shutdown or self._retries or self.spill.empty():
+            return None
+        return self.spill.get()
+
+    def _send_due_retries(self):
+        now = time.time()
+        while self._retries and self._retries[0].deadline <= now:
+            retry = self._retries.pop(0)
+            self._retry_bytes -= retry.nbytes
+            self._send(retry.frame, retry)
+
+
+class _Repeats(object):
+    __slots__ = ('entry', 'count', 'first', 'last', 'since')
+
+    def __init__(self, entry, created, since):
+        self.entry = entry
+        self.count = 1
+        self.first = self.last = created
+        self.since = since
+
+
+class AdaptiveBatching(object):
+    """
+    Batch limits for a `FlushWorker` following the traffic it sees, in the
+    spirit of Nagle's algorithm or Kafka's `linger.ms`.
+
+    Events are collected for `max_interval` seconds less the time uploads
+    take, so that they are delivered within about `max_interval` seconds, but
+    for no less than `min_interval`. A batch is sent early once it holds the
+    events expected to arrive in that time, or in twice the time an upload
+    takes if longer, so the worker keeps up with the traffic. Batches double
+    while the worker falls behind. Capacity stays between `min_capacity` and
+    `max_capacity`. Rates and upload times are smoothed with an exponential
+    moving average weighing new observations by `smoothing`.
+    """
+    def __init__(self, min_capacity, max_capacity, max_interval, min_interval=DEFAULT_MIN_FLUSH_INTERVAL,
+                 smoothing=DEFAULT_ADAPTIVE_SMOOTHING, clock=time.monotonic):
+        if not 0 < min_capacity <= max_capacity:
+            raise ValueError('Batch capacity bounds must satisfy 0 < min_capacity <= max_capacity')
+        if not 0 < min_interval <= max_interval:
+            raise ValueError('Flush interval bounds must satisfy 0 < min_interval <= max_interval')
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        self._clock = clock
+        self.capacity = min_capacity
+        self.interval = max_interval
+        # Events per second taken out of the pipe, and seconds per upload.
+        self.rate = None
+        self.upload_seconds = 0.0
+        self._events = 0
+        self._since = None
+        self._behind = False
+
+    def observe_events(self, count, behind=False):
+        """ Counts events taken for a batch; `behind` if more were left waiting. """
+        self._events += count
+        self._behind = self._behind or behind
+
+    def observe_upload(self, seconds):
+        self.upload_seconds += self.smoothing * (seconds - self.upload_seconds)
+
+    def update(self):
+        """ Returns the capacity and flush interval for the next batch. """
+        now = self._clock()
+        if self._since is not None and now > self._since:
+            # Covers the previous fill and send phases, so a worker that is
+            # falling behind sees the rate it can keep up with and grows its
+            # batches until it catches up.
+            rate = self._events / (now - self._since)
+            self.rate = rate if self.rate is None else self.rate + self.smoothing * (rate - self.rate)
+        self._since = now
+        self._events = 0
+        self.interval = min(max(self.max_interval - self.upload_seconds, self.min_interval), self.max_interval)
+        if self._behind:
+            capacity = self.capacity * 2
+        elif self.rate is not None:
+            capacity = int(self.rate * max(self.interval, 2 * self.upload_seconds))
+        else:
+            capacity = self.capacity
+        self._behind = False
+        self.capacity = min(max(capacity, self.min_capacity), self.max_capacity)
+        return self.capacity, self.interval
+
+
+class _PendingRetry(object):
+    __slots__ = ('frame', 'receipts', 'attempt', 'deadline', 'created', 'nbytes')
+
+    def __init__(self, frame, receipts=()):
+        self.frame = frame
+        self.receipts = receipts
+        self.attempt = 0
+        self.deadline = None
+        self.created = time.time()
+        # Encoded size for uploader batches, event count for plain lists.
+        self.nbytes = getattr(frame, 'nbytes', len(frame))
+
+
+_live_workers = weakref.WeakSet()
+_wake_at_exit_registered = False
+
+
+def _wake_at_exit(worker):
+    # `threading._register_atexit` callbacks run when the main thread is done
+    # but before non-daemon threads are joined, so workers waiting on their
+    # pipe can notice the parent thread is gone and send what's left.
+    global _wake_at_exit_registered
+    _live_workers.add(worker)
+    if not _wake_at_exit_registered:
+        register = getattr(threading, '_register_atexit', None)
+        if register is not None:
+            try:
+                register(_wake_live_workers)
+            except RuntimeError:
+                # Already shutting down.
+                return
+        _wake_at_exit_registered = True
+
+
+def _wake_live_workers():
+    for worker in list(_live_workers):
+        worker.pipe.wake()
+
+
+def _append(frame, entry):
+    try:
+        frame.append(entry)
+    except Exception as e:
+        # An event that can't be encoded must not take down the worker.
+        print('Dropping log event that could not be encoded: {}'.format(e))
+
+
+def _append_encoded(frame, data):
+    if hasattr(frame, 'append_encoded'):
+        frame.append_encoded(data)
+    else:
+        frame.append(msgpack.unpackb(data, raw=False))
+
+
+def _encoded_events(frame):
+    if hasattr(frame, 'encoded_events'):
+        return frame.encoded_events()
+    return [msgpack.packb(event, use_bin_type=True) for event in frame]
+
 
 def _initial_time_remaining(flush_interval):
     return flush_interval
@@ -103,5 +427,11 @@ def _calculate_time_remaining(last_flush, flush_interval):
     return time_remaining
 
 
+def _payload_bytes(upload):
+    # Uploaders know the size of what they sent; other callables don't.
+    payload_bytes = getattr(upload, 'payload_bytes', None)
+    return payload_bytes() if payload_bytes is not None else None
+
+
 def _should_retry(status_code):
     return 500 <= status_code < 600
@@ -2,24 +2,91 @@
 from __future__ import print_function, unicode_literals
 import logging
 import json
+import weakref
 
+from .compat import orjson, ujson
 from .helpers import DEFAULT_CONTEXT
 from .frame import create_frame
 
+SERIALIZERS = ('json', 'orjson', 'ujson')
+DEFAULT_SERIALIZER = 'json'
+
 
 class LogtailFormatter(logging.Formatter):
+    """
+    Formats records as JSON frames.
+
+    `serializer` picks the library encoding them: the `json` module, or the
+    faster `orjson` or `ujson` packages, which encode the same values with
+    less whitespace and without escaping non-ASCII characters. `json_default`
+    is called for the same objects whichever is used, except that orjson
+    encodes UUIDs and enums itself, and NaN as null. Frames a fast serializer
+    can't encode are encoded with the `json` module, so errors don't depend
+    on it either. `json_encoder` only applies to `json`.
+    """
     def __init__(self,
                  context=DEFAULT_CONTEXT,
                  json_default=None,
-                 json_encoder=None):
+                 json_encoder=None,
+                 serializer=DEFAULT_SERIALIZER):
         self.context = context
         self.json_default = json_default
         self.json_encoder = json_encoder
+        self.serializer = serializer
+        self._dumps = _serializer(serializer, json_default, json_encoder)
+        # The last record formatted and its line, for handlers sharing this
+        # formatter: they all format the same record one after another. The
+        # record is referenced weakly, so its arguments and traceback are
+        # freed once logging is done with it.
+        self._last = (None, None)
 
     def format(self, record):
+        last_record, line = self._last
+        if last_record is not None and last_record() is record:
+            return line
         # Because the formatter does not have an underlying format string for
         # which `extra` may be used to substitute arguments (see
         # https://docs.python.org/2/library/logging.html#logging.debug ), we
         # augment the log frame with all of the entries in extra.
         frame = create_frame(record, record.getMessage(), self.context, include_extra_attributes=True)
-        return json.dumps(frame, default=self.json_default, cls=self.json_encoder)
+        line = self._dumps(frame)
+        self._last = (weakref.ref(record), line)
+        return line
+
+
+def _serializer(serializer, default, encoder):
+    # Creating the encoder once saves `json.dumps` from configuring a new one
+    # for every record whenever `default` or `cls` is passed.
+    dumps = (encoder or json.JSONEncoder)(default=default).encode
+    if serializer == 'json':
+        return dumps
+    if encoder is not None:
+        raise ValueError('json_encoder can only be used with the json serializer')
+    if serializer == 'orjson':
+        if orjson is None:
+            raise ImportError('The orjson serializer requires the orjson package')
+        # Dates and dataclasses are left to `default`, as the json module would.
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+        def fast_dumps(frame):
+            try:
+                return orjson.dumps(frame, default=default, option=option).decode('utf-8')
+            except orjson.JSONEncodeError:
+                return dumps(frame)
+        return fast_dumps
+    if serializer == 'ujson':
+        if ujson is None:
+            raise ImportError('The ujson serializer requires the ujson package')
+        kwargs = {'ensure_ascii': False, 'escape_forward_slashes': False}
+        if default is not None:
+            kwargs['default'] = default
+
+        def fast_dumps(frame):
+            try:
+                return ujson.dumps(frame, **kwargs)
+            except (TypeError, OverflowError):
+                return dumps(frame)
+        return fast_dumps
+    raise ValueError(
+        'Unsupported serializer %r, expected one of: %s' % (serializer, ', '.join(SERIALIZERS))
+    )
@@ -2,92 +2,277 @@
 from __future__ import print_function, unicode_literals
 from datetime import datetime, timezone
 
+from functools import lru_cache
 from os import path
 import __main__
 
-def create_frame(record, message, context, include_extra_attributes=False):
+def create_frame(record, message, context, include_extra_attributes=False, serializable=False, size=None):
+    """
+    Builds the frame of a record. With `serializable`, `size` may be a list
+    holding a number, which is increased by the rough encoded size of the
+    custom context and events.
+    """
     r = record.__dict__
-    # Django sends a request object in the record, which is not JSON serializable
-    if "request" in r and not isinstance(r["request"], (dict, list, bool, int, float, str)) :
-        del r["request"]
-    frame = {}
-    frame['dt'] = datetime.fromtimestamp(r['created'], timezone.utc).isoformat()
-    frame['level'] = _levelname(r['levelname'])
-    frame['severity'] = int(r['levelno'] / 10)
-    frame['message'] = message
-    frame['context'] = ctx = {}
+    _drop_request(r)
+    frame = _build_frame(
+        r['created'], r['levelname'], r['levelno'], message, r['pathname'], r['lineno'], r['funcName'],
+        r['thread'], r['threadName'], r['name'], r['process'], r['processName'],
+    )
 
-    # Runtime context
-    ctx['runtime'] = runtime = {}
-    runtime['function'] = r['funcName']
-    runtime['file'] = _relative_to_main_module_if_possible(r['pathname'])
-    runtime['line'] = r['lineno']
-    runtime['thread_id'] = r['thread']
-    runtime['thread_name'] = r['threadName']
-    runtime['logger_name'] = r['name']
-
-    # Runtime context
-    ctx['system'] = system = {}
-    system['pid'] = r['process']
-    system['process_name'] = r['processName']
+    # Only the custom context and events can hold user supplied values; the
+    # rest of the frame is built from scalars and needs no walking.
+    clean = _make_serializable if serializable else _remove_circular_dependencies
 
     # Custom context
     if context.exists():
-        ctx.update(context.collapse())
+        frame['context'].update(_clean_context(context.collapse(), clean, size))
 
     events = _parse_custom_events(record, include_extra_attributes)
     if events:
-        frame.update(events)
+        _update_clean(frame, events, clean, size)
+
+    return frame
+
+def create_compact_event(record, message, context, include_extra_attributes=False, size=None):
+    """
+    Same event as `create_frame(..., serializable=True)` would return, kept
+    as the record's fields until `CompactEvent.to_frame` is called. `size`
+    is increased as `create_frame` does.
+    """
+    r = record.__dict__
+    _drop_request(r)
+    # Extra attributes may be modified once the logging call returns, so they
+    # are copied right away; the collapsed context is never modified.
+    extras = _parse_custom_events(record, include_extra_attributes)
+    events = None
+    if extras:
+        events = {}
+        _update_clean(events, extras, _make_serializable, size)
+    collapsed = context.collapse() if context.exists() else None
+    if collapsed is not None and size is not None:
+        # Measured on the copy `to_frame` will use, which is cached until
+        # the context changes.
+        _clean_context(collapsed, _make_serializable, size)
+    return CompactEvent(
+        r['created'], r['levelname'], r['levelno'], message, r['pathname'], r['lineno'], r['funcName'],
+        r['thread'], r['threadName'], r['name'], r['process'], r['processName'],
+        collapsed, events,
+        r['msg'] if isinstance(r['msg'], str) else None,
+    )
+
+class CompactEvent(object):
+    __slots__ = (
+        'created', 'levelname', 'levelno', 'message', 'pathname', 'lineno', 'func_name',
+        'thread', 'thread_name', 'name', 'process', 'process_name', 'context', 'events', 'template',
+    )
+
+    def __init__(self, created, levelname, levelno, message, pathname, lineno, func_name,
+                 thread, thread_name, name, process, process_name, context, events, template=None):
+        self.created = created
+        self.levelname = levelname
+        self.levelno = levelno
+        self.message = message
+        self.pathname = pathname
+        self.lineno = lineno
+        self.func_name = func_name
+        self.thread = thread
+        self.thread_name = thread_name
+        self.name = name
+        self.process = process
+        self.process_name = process_name
+        self.context = context
+        self.events = events
+        # Message before formatting, for telling repeats of the same event apart.
+        self.template = template
+
+    def to_frame(self):
+        frame = _build_frame(
+            self.created, self.levelname, self.levelno, self.message, self.pathname, self.lineno, self.func_name,
+            self.thread, self.thread_name, self.name, self.process, self.process_name,
+        )
+        if self.context is not None:
+            frame['context'].update(_clean_context(self.context, _make_serializable))
+        if self.events:
+            frame.update(self.events)
+        return frame
+
+def _build_frame(created, levelname, levelno, message, pathname, lineno, func_name,
+                 thread, thread_name, name, process, process_name):
+    frame = {}
+    frame['dt'] = _isoformat(created)
+    frame['level'] = _levelname(levelname)
+    frame['severity'] = int(levelno / 10)
+    frame['message'] = message
+    frame['context'] = ctx = {}
+
+    # Runtime context
+    ctx['runtime'] = runtime = _call_site(pathname, lineno, func_name).copy()
+    runtime['thread_id'] = thread
+    runtime['thread_name'] = thread_name
+    runtime['logger_name'] = name
 
-    return _remove_circular_dependencies(frame)
+    # System context, shared by the frames of each process
+    ctx['system'] = _system(process, process_name)
+    return frame
+
+def _drop_request(r):
+    # Django sends a request object in the record, which is not JSON serializable
+    if "request" in r and not isinstance(r["request"], (dict, list, bool, int, float, str)) :
+        del r["request"]
+
+_DEFAULT_KEYS = frozenset((
+    'args', 'asctime', 'created', 'exc_info', 'exc_text', 'pathname',
+    'funcName', 'levelname', 'levelno', 'lineno', 'module', 'msecs',
+    'message', 'msg', 'name', 'process', 'processName',
+    'relativeCreated', 'thread', 'threadName'
+))
 
 def _parse_custom_events(record, include_extra_attributes):
-    default_keys = {
-        'args', 'asctime', 'created', 'exc_info', 'exc_text', 'pathname',
-        'funcName', 'levelname', 'levelno', 'lineno', 'module', 'msecs',
-        'message', 'msg', 'name', 'process', 'processName',
-        'relativeCreated', 'thread', 'threadName'
-    }
     events = {}
     for key, val in record.__dict__.items():
-        if key in default_keys:
+        if key in _DEFAULT_KEYS:
             continue
         if not include_extra_attributes and not isinstance(val, dict):
             continue
         events[key] = val
     return events
 
+_SCALARS = (str, int, float, bool, type(None))
+# Rough encoded size of a key, or of any value but a string.
+_ITEM_BYTES = 16
+
+def _update_clean(target, values, clean, size=None):
+    # `size` can only be counted by `_make_serializable`.
+    for key, value in values.items():
+        if isinstance(value, _SCALARS):
+            target[key] = value
+            if size is not None:
+                size[0] += len(value) if isinstance(value, str) else _ITEM_BYTES
+        elif size is None:
+            target[key] = clean(value, set())
+        else:
+            target[key] = clean(value, set(), size)
+    if size is not None:
+        size[0] += _ITEM_BYTES * len(values)
+
+# Last collapsed context cleaned by each function, with its size when made
+# serializable. Collapsed contexts are cached by `LogtailContext` until it
+# changes, so consecutive records usually share the cleaned copy too; it is
+# never modified once built.
+_cleaned_contexts = {}
+
+def _clean_context(collapsed, clean, size=None):
+    cached = _cleaned_contexts.get(clean)
+    if cached is None or cached[0] is not collapsed:
+        cleaned = {}
+        measured = [0] if clean is _make_serializable else None
+        _update_clean(cleaned, collapsed, clean, measured)
+        cached = _cleaned_contexts[clean] = (collapsed, cleaned, measured[0] if measured else 0)
+    if size is not None:
+        size[0] += cached[2]
+    return cached[1]
+
 def _remove_circular_dependencies(obj, memo=None):
+    # `memo` holds the ids of the containers on the path from the root to
+    # `obj`, so a container referenced twice from different branches is kept.
     if memo is None:
         memo = set()
 
     # Skip immutable types, which can't contain circular dependencies
-    if isinstance(obj, (str, int, float, bool, type(None))):
+    if isinstance(obj, _SCALARS):
         return obj
 
-    # For mutable objects, check for circular references
+    if not isinstance(obj, (dict, list, tuple, set)):
+        return obj
+
+    # For containers, check for circular references
     obj_id = id(obj)
     if obj_id in memo:
         return "<omitted circular reference>"
     memo.add(obj_id)
 
     if isinstance(obj, dict):
-        new_dict = {}
-        for key, value in obj.items():
-            new_dict[key] = _remove_circular_dependencies(value, memo.copy())
-        return new_dict
+        result = {key: _remove_circular_dependencies(value, memo) for key, value in obj.items()}
     elif isinstance(obj, list):
-        return [_remove_circular_dependencies(item, memo.copy()) for item in obj]
+        result = [_remove_circular_dependencies(item, memo) for item in obj]
     elif isinstance(obj, tuple):
-        return tuple(_remove_circular_dependencies(item, memo.copy()) for item in obj)
-    elif isinstance(obj, set):
-        return {_remove_circular_dependencies(item, memo.copy()) for item in obj}
+        result = tuple(_remove_circular_dependencies(item, memo) for item in obj)
     else:
+        result = {_remove_circular_dependencies(item, memo) for item in obj}
+
+    memo.discard(obj_id)
+    return result
+
+def _make_serializable(obj, ancestors, size=None):
+    # Single pass equivalent of `json.loads(json.dumps(obj, default=str))`:
+    # circular references are omitted, tuples become lists, non-string keys
+    # are converted the way the JSON encoder would and any value that has no
+    # JSON (and therefore msgpack) representation is replaced by its `str()`.
+    # `size`, a list holding a number, is increased by the rough encoded
+    # size of the result.
+    if isinstance(obj, _SCALARS):
+        if size is not None:
+            size[0] += len(obj) if isinstance(obj, str) else _ITEM_BYTES
         return obj
 
+    if isinstance(obj, (dict, list, tuple)):
+        obj_id = id(obj)
+        if obj_id in ancestors:
+            return "<omitted circular reference>"
+        ancestors.add(obj_id)
+        if isinstance(obj, dict):
+            if size is not None:
+                size[0] += _ITEM_BYTES * len(obj)
+            result = {
+                _serializable_key(key): _make_serializable(value, ancestors, size)
+                for key, value in obj.items()
+            }
+        else:
+            result = [_make_serializable(item, ancestors, size) for item in obj]
+        ancestors.discard(obj_id)
+        return result
+
+    obj = str(obj)
+    if size is not None:
+        size[0] += len(obj)
+    return obj
+
+def _serializable_key(key):
+    if isinstance(key, str):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, float):
+        return float.__repr__(key)
+    if isinstance(key, int):
+        return int.__repr__(key)
+    return str(key)
+
+@lru_cache(maxsize=4096)
+def _call_site(pathname, lineno, func_name):
+    return {
+        'function': func_name,
+        'file': _relative_to_main_module_if_possible(pathname),
+        'line': lineno,
+    }
+
+# Keyed on the record's process rather than computed once, so records of a
+# forked child (or passed along from another process) get their own.
+@lru_cache(maxsize=64)
+def _system(pid, process_name):
+    return {'pid': pid, 'process_name': process_name}
+
+def _isoformat(created):
+    return datetime.fromtimestamp(created, timezone.utc).isoformat()
+
 def _levelname(level):
     return level.lower()
 
+@lru_cache(maxsize=1024)
 def _relative_to_main_module_if_possible(pathname):
     has_main_module = hasattr(__main__, '__file__')
     return _relative_to_main_module(pathname) if has_main_module else pathname
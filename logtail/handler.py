@@ -1,13 +1,28 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
 import logging
-import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter
+
+from requests.adapters import DEFAULT_POOLSIZE
 
 from .compat import queue
+from .pipe import Pipe
 from .helpers import DEFAULT_CONTEXT
-from .flusher import FlushWorker
-from .uploader import Uploader
-from .frame import create_frame
+from .flusher import (
+    FlushWorker, AdaptiveBatching, RETRY_SCHEDULE, DEFAULT_RETRY_JITTER, DEFAULT_MAX_RETRY_BYTES,
+    DEFAULT_COALESCE_WINDOW, DEFAULT_MIN_FLUSH_INTERVAL,
+)
+from .uploader import Uploader, HTTP2Uploader, SocketUploader
+from .spill import SpillQueue, DEFAULT_SPILL_SEGMENT_BYTES, DEFAULT_SPILL_MAX_BYTES
+from .stats import Stats
+from .frame import (
+    create_frame, create_compact_event, CompactEvent, _clean_context, _drop_request, _levelname,
+    _make_serializable, _parse_custom_events, _update_clean,
+)
 
 DEFAULT_HOST = 'in.logs.betterstack.com'
 DEFAULT_BUFFER_CAPACITY = 1000
@@ -17,6 +32,36 @@ DEFAULT_RAISE_EXCEPTIONS = False
 DEFAULT_DROP_EXTRA_EVENTS = True
 DEFAULT_INCLUDE_EXTRA_ATTRIBUTES = True
 DEFAULT_TIMEOUT = 30
+DEFAULT_DEFERRED_FORMATTING = False
+DEFAULT_COMPACT_EVENTS = False
+DEFAULT_ENCODED_EVENTS = False
+DEFAULT_SAMPLER = None
+DEFAULT_COALESCE = False
+DEFAULT_COMPRESSION = None
+DEFAULT_COMPRESSION_LEVEL = None
+DEFAULT_WORKERS = 1
+DEFAULT_SPILL_DIRECTORY = None
+DEFAULT_SHIPPER_ADDRESS = None
+DEFAULT_POOL_SIZE = None
+DEFAULT_KEEPALIVE = True
+DEFAULT_SHARE_SESSION = False
+DEFAULT_HTTP2 = False
+DEFAULT_WARM_UP = True
+DEFAULT_ADAPTIVE = False
+DEFAULT_MAX_BATCH_EVENTS = None
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_EVENT_BYTES = 1024 * 1024
+DEFAULT_MAX_BUFFER_BYTES = 32 * 1024 * 1024
+# Fraction of the buffer events of each level (and up to the next one) may
+# fill, so that a flood of debug logs can't push out warnings and errors.
+DEFAULT_LEVEL_BUDGETS = {
+    logging.DEBUG: 0.5,
+    logging.INFO: 0.75,
+    logging.WARNING: 0.9,
+    logging.ERROR: 1.0,
+}
+# Rough encoded size of a frame besides its message.
+EVENT_OVERHEAD_BYTES = 400
 
 
 class LogtailHandler(logging.Handler):
@@ -31,56 +76,379 @@ class LogtailHandler(logging.Handler):
                  include_extra_attributes=DEFAULT_INCLUDE_EXTRA_ATTRIBUTES,
                  context=DEFAULT_CONTEXT,
                  timeout=DEFAULT_TIMEOUT,
+                 deferred_formatting=DEFAULT_DEFERRED_FORMATTING,
+                 compact_events=DEFAULT_COMPACT_EVENTS,
+                 encoded_events=DEFAULT_ENCODED_EVENTS,
+                 compression=DEFAULT_COMPRESSION,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 workers=DEFAULT_WORKERS,
+                 retry_schedule=RETRY_SCHEDULE,
+                 retry_jitter=DEFAULT_RETRY_JITTER,
+                 max_retry_bytes=DEFAULT_MAX_RETRY_BYTES,
+                 spill_directory=DEFAULT_SPILL_DIRECTORY,
+                 spill_segment_bytes=DEFAULT_SPILL_SEGMENT_BYTES,
+                 spill_max_bytes=DEFAULT_SPILL_MAX_BYTES,
+                 batch_bytes=DEFAULT_BATCH_BYTES,
+                 max_event_bytes=DEFAULT_MAX_EVENT_BYTES,
+                 max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                 level_budgets=DEFAULT_LEVEL_BUDGETS,
+                 shipper_address=DEFAULT_SHIPPER_ADDRESS,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 keepalive=DEFAULT_KEEPALIVE,
+                 share_session=DEFAULT_SHARE_SESSION,
+                 http2=DEFAULT_HTTP2,
+                 warm_up=DEFAULT_WARM_UP,
+                 sampler=DEFAULT_SAMPLER,
+                 coalesce=DEFAULT_COALESCE,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW,
+                 adaptive=DEFAULT_ADAPTIVE,
+                 max_batch_events=DEFAULT_MAX_BATCH_EVENTS,
                  level=logging.NOTSET):
         super(LogtailHandler, self).__init__(level=level)
+        if workers < 1:
+            raise ValueError('At least one worker is required')
+        if deferred_formatting + compact_events + encoded_events > 1:
+            raise ValueError('Only one of deferred_formatting, compact_events and encoded_events can be enabled')
+        if coalesce and encoded_events:
+            raise ValueError('Encoded events can not be coalesced')
         self.source_token = source_token
-        if host.startswith('https://') or host.startswith('http://'):
-            self.host = host
-        else:
-            self.host = "https://" + host
+        self.host = _host_url(host)
         self.context = context
-        self.pipe = queue.Queue(maxsize=buffer_capacity)
-        self.uploader = Uploader(self.source_token, self.host, timeout)
+        # Events waiting to be sent are bounded by `buffer_capacity` and by
+        # their estimated size; see `level_budgets` for how the room is shared.
+        self.pipe = Pipe(maxsize=buffer_capacity, max_bytes=max_buffer_bytes)
+        self.level_budgets = sorted(level_budgets.items())
+        if shipper_address is not None:
+            # Batches go to the `Shipper` listening on this Unix socket, which
+            # uploads the events of all processes on the host together.
+            self.uploader = SocketUploader(shipper_address, max_event_bytes=max_event_bytes)
+        else:
+            # Each worker keeps a connection open unless the pool is smaller;
+            # with `share_session`, handlers posting to the same host share
+            # their pool, so it may need to be larger than `workers`.
+            self.uploader = (HTTP2Uploader if http2 else Uploader)(
+                self.source_token,
+                self.host,
+                timeout,
+                compression=compression,
+                compression_level=compression_level,
+                max_event_bytes=max_event_bytes,
+                pool_size=pool_size or max(workers, DEFAULT_POOLSIZE),
+                keepalive=keepalive,
+                share_session=share_session,
+            )
+        # Connect as soon as the flush workers start, on the first emit.
+        self.warm_up = warm_up
         self.drop_extra_events = drop_extra_events
         self.include_extra_attributes = include_extra_attributes
         self.buffer_capacity = buffer_capacity
+        # Batches are sent once they reach `batch_bytes` of encoded events, and
+        # single events are truncated to `max_event_bytes`, so a request is at
+        # most about `batch_bytes + max_event_bytes` before compression.
+        self.batch_bytes = batch_bytes
         self.flush_interval = flush_interval
         self.check_interval = check_interval
+        # With `adaptive`, each worker sizes its batches from the traffic it
+        # sees, between `buffer_capacity` and `max_batch_events` events
+        # (ten times `buffer_capacity` by default), and sends them within
+        # about `flush_interval` seconds including the upload.
+        self.adaptive = adaptive
+        self.max_batch_events = max_batch_events or 10 * buffer_capacity
         self.raise_exceptions = raise_exceptions
-        self.dropcount = 0
-        # Do not initialize the flush thread yet because it causes issues on Render.
-        self.flush_thread = None
+        # Optional `Sampler` deciding which records are kept at all.
+        self.sampler = sampler
+        self.deferred_formatting = deferred_formatting
+        # Queue events as `CompactEvent`s, turned into frames right before
+        # they are encoded, which takes a fraction of the memory while they
+        # wait in the pipe.
+        self.compact_events = compact_events or (coalesce and not deferred_formatting)
+        # Queue events encoded with msgpack on the logging thread; the flush
+        # workers only concatenate them, and their size in the pipe is exact.
+        self.encoded_events = encoded_events
+        # Merge repeats of an event (same logger, level and message template)
+        # taken out of the pipe within `coalesce_window` seconds into one.
+        # Frames don't keep the template, so events are queued as compact
+        # events unless deferred formatting is enabled.
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self.retry_schedule = retry_schedule
+        self.retry_jitter = retry_jitter
+        self.max_retry_bytes = max_retry_bytes
+        # When enabled, events that would be dropped because the pipe is full
+        # are written to disk instead and uploaded once the workers catch up,
+        # including by the next process using the same directory.
+        self.spill = None
+        if spill_directory is not None:
+            self.spill = SpillQueue(spill_directory, segment_bytes=spill_segment_bytes, max_bytes=spill_max_bytes)
+        # Events dropped because the buffer was full or their frame could not
+        # be built, by level name.
+        self.dropcounts = Counter()
+        self._stats = Stats()
+        # Do not initialize the flush threads yet because it causes issues on Render.
+        # All workers take events from the same pipe, so each one keeps its own
+        # batch in flight; events are ordered within a worker's batches only.
+        self.flush_threads = [None] * workers
+        self._flush_threads_lock = threading.Lock()
+        _track_for_fork(self)
+
+    @property
+    def dropcount(self):
+        return sum(self.dropcounts.values())
+
+    @property
+    def flush_thread(self):
+        return self.flush_threads[0]
 
     def ensure_flush_thread_alive(self):
-        if self.flush_thread and self.flush_thread.is_alive():
+        if all(t and t.is_alive() for t in self.flush_threads):
             return
 
-        self.flush_thread = FlushWorker(
+        with self._flush_threads_lock:
+            for i, flush_thread in enumerate(self.flush_threads):
+                if not (flush_thread and flush_thread.is_alive()):
+                    self.flush_threads[i] = self._start_flush_thread()
+
+    def _start_flush_thread(self):
+        flush_thread = FlushWorker(
             self.uploader,
             self.pipe,
             self.buffer_capacity,
             self.flush_interval,
             self.check_interval,
+            prepare=self._prepare if self.deferred_formatting or self.compact_events else None,
+            new_batch=self.uploader.new_batch,
+            retry_schedule=self.retry_schedule,
+            retry_jitter=self.retry_jitter,
+            max_retry_bytes=self.max_retry_bytes,
+            spill=self.spill,
+            batch_bytes=self.batch_bytes,
+            encoded=self.encoded_events,
+            coalesce=_coalesce_key if self.coalesce else None,
+            coalesce_window=self.coalesce_window,
+            stats=self._stats,
+            warm_up=self.uploader.warm_up if self.warm_up else None,
+            adaptive=self._create_adaptive_batching() if self.adaptive else None,
+        )
+        flush_thread.start()
+        return flush_thread
+
+    def _create_adaptive_batching(self):
+        return AdaptiveBatching(
+            self.buffer_capacity,
+            max(self.max_batch_events, self.buffer_capacity),
+            self.flush_interval,
+            min_interval=min(DEFAULT_MIN_FLUSH_INTERVAL, self.flush_interval),
         )
-        self.flush_thread.start()
 
     def emit(self, record):
+        start = time.perf_counter()
         try:
-            self.ensure_flush_thread_alive()
-
-            message = self.format(record)
-            frame = create_frame(record, message, self.context, include_extra_attributes=self.include_extra_attributes)
-            serializable_frame = json.loads(json.dumps(frame, default=str))
-            try:
-                self.pipe.put(serializable_frame, block=(not self.drop_extra_events))
-            except queue.Full:
-                # Only raised when not blocking, which means that extra events
-                # should be dropped.
-                self.dropcount += 1
+            if self.sampler is not None:
+                summary = self.sampler.take_summary()
+                if summary is not None:
+                    self._enqueue(summary)
+                # Runs before anything else, so suppressed records cost
+                # next to nothing.
+                if not self.sampler.allow(record):
+                    return
+            self._enqueue(record)
         except Exception as e:
+            # The record's frame (or that of the summary) could not be built.
+            self.dropcounts[_levelname(record.levelname)] += 1
             if self.raise_exceptions:
                 raise e
+        finally:
+            self._stats.emit_seconds.observe(time.perf_counter() - start)
+
+    def stats(self):
+        """
+        Snapshot of the handler's counters: see `logtail.stats.to_prometheus`
+        for exporting it.
+        """
+        stats = self._stats.snapshot()
+        stats['queue_depth'] = self.pipe.qsize()
+        stats['queue_bytes'] = self.pipe.nbytes
+        stats['queue_high_water'] = self.pipe.high_water
+        stats['dropped'] = dict(self.dropcounts)
+        if self.spill is not None:
+            stats['spilled'] = len(self.spill)
+        return stats
+
+    def _enqueue(self, record):
+        self.ensure_flush_thread_alive()
+
+        # Rough encoded size of the custom context and events, counted while
+        # they are copied.
+        size = [0]
+        if self.deferred_formatting:
+            entry = _DeferredRecord(record, self.context, self.include_extra_attributes, size)
+        elif self.compact_events:
+            entry = self._create_compact_event(record, size)
+        elif self.encoded_events:
+            entry = self.uploader.encode(self._create_frame(record, self.context))
+        else:
+            entry = self._create_frame(record, self.context, size)
+        try:
+            self.pipe.put(
+                entry,
+                block=(not self.drop_extra_events),
+                nbytes=_estimate_bytes(entry, size[0]),
+                share=self._level_budget(record.levelno),
+            )
+        except queue.Full:
+            # Only raised when not blocking, which means that extra events
+            # should be spilled to disk or dropped.
+            if self.spill is not None:
+                self._spill(entry)
+            else:
+                self.dropcounts[_levelname(record.levelname)] += 1
+
+    def _reinit_after_fork(self):
+        # The flush threads don't exist in a forked child and the pipe's locks
+        # may have been held by one of them, so the child starts over with
+        # its own. Events queued before the fork are left to the parent, as
+        # is the spill directory slot, whose segments can't be shared: the
+        # child claims a slot of its own in the same directory.
+        self.pipe = Pipe(maxsize=self.pipe.maxsize, max_bytes=self.pipe.max_bytes)
+        self.flush_threads = [None] * len(self.flush_threads)
+        self._flush_threads_lock = threading.Lock()
+        self.uploader._reset_after_fork()
+        if self.spill is not None:
+            spill = self.spill
+            # Leaves the slot to the parent alone, so it is free once it exits.
+            spill.release()
+            self.spill = SpillQueue(spill.directory, segment_bytes=spill.segment_bytes, max_bytes=spill.max_bytes)
+        self.dropcounts = Counter()
+        self._stats = Stats()
 
     def flush(self):
-        if self.flush_thread and self.flush_thread.is_alive():
-             self.flush_thread.flush()
+        for flush_thread in self.flush_threads:
+            if flush_thread and flush_thread.is_alive():
+                flush_thread.flush()
+
+    def _create_frame(self, record, context, size=None):
+        message = self.format(record)
+        return create_frame(
+            record,
+            message,
+            context,
+            include_extra_attributes=self.include_extra_attributes,
+            serializable=True,
+            size=size,
+        )
+
+    def _create_compact_event(self, record, size=None):
+        return create_compact_event(
+            record,
+            self.format(record),
+            self.context,
+            include_extra_attributes=self.include_extra_attributes,
+            size=size,
+        )
+
+    def _prepare(self, entry):
+        # Runs on the flush thread in deferred formatting and compact events
+        # modes. Errors can't be raised to the caller at this point, so the
+        # event is dropped instead.
+        try:
+            if isinstance(entry, CompactEvent):
+                # The context is only cleaned here, so its values may fail
+                # to convert just like a deferred record's.
+                return entry.to_frame()
+            if isinstance(entry, _DeferredRecord):
+                return self._create_frame(logging.makeLogRecord(entry.attrs), entry.context)
+            return entry
+        except Exception:
+            levelname = entry.levelname if isinstance(entry, CompactEvent) else entry.attrs['levelname']
+            self.dropcounts[_levelname(levelname)] += 1
+            return None
+
+    def _level_budget(self, levelno):
+        budget = self.level_budgets[0][1] if self.level_budgets else 1.0
+        for level, share in self.level_budgets:
+            if level > levelno:
+                break
+            budget = share
+        return budget
+
+
+    def _spill(self, entry):
+        if isinstance(entry, bytes):
+            self.spill.put(entry)
+            return
+        frame = self._prepare(entry)
+        if frame is not None:
+            self.spill.put(self.uploader.encode(frame))
+
+
+def _host_url(host):
+    if host.startswith('https://') or host.startswith('http://'):
+        return host
+    return "https://" + host
+
+
+_live_handlers = weakref.WeakSet()
+_at_fork_registered = False
+
+
+def _track_for_fork(handler):
+    global _at_fork_registered
+    _live_handlers.add(handler)
+    if not _at_fork_registered and hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_reinit_live_handlers)
+        _at_fork_registered = True
+
+
+def _reinit_live_handlers():
+    for handler in list(_live_handlers):
+        handler._reinit_after_fork()
+
+
+def _coalesce_key(entry):
+    # Repeats are told apart by logger, level and message template.
+    if isinstance(entry, CompactEvent):
+        name, levelno, created = entry.name, entry.levelno, entry.created
+    elif isinstance(entry, _DeferredRecord):
+        attrs = entry.attrs
+        name, levelno, created = attrs['name'], attrs['levelno'], attrs['created']
+    else:
+        return None
+    if entry.template is None:
+        return None
+    return (name, levelno, entry.template), created
+
+
+def _estimate_bytes(entry, custom_bytes):
+    if isinstance(entry, bytes):
+        return len(entry)
+    # Only meant to be cheap: the message and the custom context and events
+    # (`custom_bytes`) are what make an event large, the rest of the frame
+    # is about the same size for every event.
+    if isinstance(entry, _DeferredRecord):
+        message = entry.attrs.get('msg')
+    elif isinstance(entry, CompactEvent):
+        message = entry.message
+    else:
+        message = entry.get('message')
+    return EVENT_OVERHEAD_BYTES + custom_bytes + (len(message) if isinstance(message, str) else 0)
+
+
+class _DeferredRecord(object):
+    # Snapshot of a LogRecord taken on the logging thread. The message
+    # arguments are rendered and the extra attributes copied eagerly, as
+    # `create_compact_event` does, because they may be mutated after the call
+    # returns; building the frame is left to the flush thread.
+    __slots__ = ('attrs', 'context', 'template')
+
+    def __init__(self, record, context, include_extra_attributes, size=None):
+        self.template = record.msg if isinstance(record.msg, str) else None
+        # Left out of the frame, as `create_frame` would, rather than sent as
+        # its `str()`.
+        _drop_request(record.__dict__)
+        self.attrs = attrs = record.__dict__.copy()
+        attrs['msg'] = record.getMessage()
+        attrs['args'] = None
+        _update_clean(attrs, _parse_custom_events(record, include_extra_attributes), _make_serializable, size)
+        self.context = context.snapshot()
+        if size is not None and self.context.exists():
+            _clean_context(self.context.collapse(), _make_serializable, size)
@@ -1,24 +1,38 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
+import contextvars
+import threading
+
+from .frame import _remove_circular_dependencies
 
 
 class LogtailContext(object):
     def __init__(self):
-        self.extras = []
+        # Top of the context stack. Every thread and asyncio task sees its own
+        # value, and entering a context sets a new node pointing at the
+        # previous one instead of changing it, so stacks are never shared.
+        self._stack = contextvars.ContextVar('logtail_context', default=None)
+        # Contexts of the whole process, under every stack. Replaced rather
+        # than modified, so readers need no lock.
+        self._global = {}
+        self._global_lock = threading.Lock()
 
     def context(self, *args, **kwargs):
-        if args:
-            raise ValueError(
-                'All contexts must be passed by name as keyword arguments'
-            )
-        for key, val in kwargs.items():
-            if not isinstance(val, dict):
-                raise ValueError(
-                    'All contexts must be dictionaries: %s' % key
-                )
-        self.extras.append(kwargs)
+        contexts = _copy_contexts(args, kwargs)
+        self._stack.set(_ContextNode(self._stack.get(), contexts))
         return self
 
+    def global_context(self, *args, **kwargs):
+        """
+        Adds contexts seen by every thread and asyncio task, e.g. the name and
+        version of the app set at startup. Contexts entered with `with` are
+        merged over them. A context entered without `with` only applies to
+        the thread or task entering it.
+        """
+        contexts = _copy_contexts(args, kwargs)
+        with self._global_lock:
+            self._global = _merge(self._global, contexts)
+
     def __call__(self, *args, **kwargs):
         return self.context(*args, **kwargs)
 
@@ -26,20 +40,96 @@ class LogtailContext(object):
         return self
 
     def __exit__(self, type_, value, traceback):
-        if type_ is not None:
-            return False
-        self.extras.pop()
-        return self
+        node = self._stack.get()
+        if node is not None:
+            self._stack.set(node.parent)
+        return False
+
+    @property
+    def extras(self):
+        extras = []
+        node = self._top()
+        while node is not None:
+            extras.append(node.contexts)
+            node = node.parent
+        base = self._base()
+        if base:
+            extras.append(base)
+        extras.reverse()
+        return extras
 
     def exists(self):
-        return bool(self.extras)
+        return self._top() is not None or bool(self._base())
 
     def collapse(self):
-        x = {}
-        for contexts in self.extras:
-            for name, data in contexts.items():
-                x.setdefault(name, {}).update(data)
+        node = self._top()
+        base = self._base()
+        return node.collapse(base) if node is not None else base
+
+    def snapshot(self):
+        # Frozen copy of the current context, for frames built on another thread.
+        return _ContextSnapshot(self._top(), self._base())
+
+    def _base(self):
+        return self._global
+
+    def _top(self):
+        return self._stack.get()
+
+
+class _ContextSnapshot(LogtailContext):
+    def __init__(self, node, base):
+        self._node = node
+        self._global = base
+
+    def _top(self):
+        return self._node
+
+
+class _ContextNode(object):
+    __slots__ = ('parent', 'contexts', '_collapsed')
+
+    def __init__(self, parent, contexts):
+        self.parent = parent
+        self.contexts = contexts
+        # Built on first use from the parent's collapsed view and never
+        # modified afterwards, so it can be shared with frames and snapshots.
+        # Kept with the global contexts it was built on, and rebuilt when
+        # those change.
+        self._collapsed = None
+
+    def collapse(self, base):
+        cached = self._collapsed
+        if cached is not None and cached[0] is base:
+            return cached[1]
+        x = _merge(self.parent.collapse(base) if self.parent is not None else base, self.contexts)
+        self._collapsed = (base, x)
         return x
 
 
+def _copy_contexts(args, kwargs):
+    if args:
+        raise ValueError(
+            'All contexts must be passed by name as keyword arguments'
+        )
+    for key, val in kwargs.items():
+        if not isinstance(val, dict):
+            raise ValueError(
+                'All contexts must be dictionaries: %s' % key
+            )
+    # Contexts are copied (nested containers too) when entered, so what
+    # frames carry is the data as it was then: changes made to it later
+    # are not seen, which lets collapsed contexts be cached.
+    return {key: _remove_circular_dependencies(val) for key, val in kwargs.items()}
+
+
+def _merge(collapsed, contexts):
+    x = dict(collapsed)
+    for name, data in contexts.items():
+        merged = dict(x.get(name, ()))
+        merged.update(data)
+        x[name] = merged
+    return x
+
+
 DEFAULT_CONTEXT = LogtailContext()
@@ -0,0 +1,96 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import time
+from collections import deque
+
+from .compat import queue
+
+
+class Pipe(queue.Queue):
+    """
+    Queue whose blocked consumers can be woken up without an item, bounded by
+    the approximate size of its items as well as by their number.
+    """
+    def __init__(self, maxsize=0, max_bytes=0):
+        queue.Queue.__init__(self, maxsize)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # Most items the pipe has held at once.
+        self.high_water = 0
+        self._sizes = deque()
+        self._wakeups = 0
+        self._wakeup_pending = False
+
+    def put(self, item, block=True, timeout=None, nbytes=0, share=1.0):
+        # `share` is the fraction of `maxsize` and `max_bytes` the pipe may
+        # be filled to for this item to be admitted, which keeps the rest
+        # free for items put with a larger share.
+        with self.not_full:
+            if block and timeout is not None and timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            endtime = None if timeout is None else time.monotonic() + timeout
+            while not self._admits(nbytes, share):
+                if not block:
+                    raise queue.Full
+                if endtime is None:
+                    self.not_full.wait()
+                else:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Full
+                    self.not_full.wait(remaining)
+            self._put(item)
+            self.high_water = max(self.high_water, self._qsize())
+            self._sizes.append(nbytes)
+            self.nbytes += nbytes
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _admits(self, nbytes, share):
+        # An empty pipe takes anything, so an item is never refused forever.
+        size = self._qsize()
+        if not size:
+            return True
+        if self.maxsize > 0 and size + 1 > self.maxsize * share:
+            return False
+        if self.max_bytes > 0 and self.nbytes + nbytes > self.max_bytes * share:
+            return False
+        return True
+
+    def wake(self):
+        # Every `get` blocked at this point raises `queue.Empty` right away,
+        # letting flush workers react to flush requests and shutdown. If none
+        # is blocked, the next one that would block returns immediately.
+        with self.not_empty:
+            self._wakeups += 1
+            self._wakeup_pending = True
+            self.not_empty.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if self._wakeup_pending and not self._qsize():
+                self._wakeup_pending = False
+                raise queue.Empty
+            wakeups = self._wakeups
+            if block:
+                if timeout is None:
+                    while not self._qsize() and wakeups == self._wakeups:
+                        self.not_empty.wait()
+                elif timeout < 0:
+                    raise ValueError("'timeout' must be a non-negative number")
+                else:
+                    endtime = time.monotonic() + timeout
+                    while not self._qsize() and wakeups == self._wakeups:
+                        remaining = endtime - time.monotonic()
+                        if remaining <= 0.0:
+                            break
+                        self.not_empty.wait(remaining)
+            if not self._qsize():
+                self._wakeup_pending = False
+                raise queue.Empty
+            item = self._get()
+            self.nbytes -= self._sizes.popleft()
+            # Items may be waiting for different shares, so all of them
+            # need to check whether they fit now.
+            self.not_full.notify_all()
+            return item
@@ -0,0 +1,135 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+DEFAULT_ALWAYS_KEEP_LEVEL = logging.ERROR
+DEFAULT_SUMMARY_INTERVAL = 60  # seconds
+SUMMARY_LOGGER_NAME = 'logtail.sampling'
+
+
+class Sampler(object):
+    """
+    Decides which records `LogtailHandler` keeps before any work is done on
+    them.
+
+    `logger_ratios` maps logger names to the fraction of their records to
+    keep, applying to child loggers as well, and `level_ratios` maps levels to
+    the fraction of records of that level (and up to the next one) to keep;
+    both apply when a record matches both. `rate` limits each call site to
+    that many records per second, with bursts of up to `burst` records.
+    Records at `always_keep_level` or above are always kept.
+
+    Suppressed records are counted and reported every `summary_interval`
+    seconds by a summary event.
+    """
+    def __init__(self,
+                 logger_ratios=None,
+                 level_ratios=None,
+                 rate=None,
+                 burst=None,
+                 always_keep_level=DEFAULT_ALWAYS_KEEP_LEVEL,
+                 summary_interval=DEFAULT_SUMMARY_INTERVAL,
+                 clock=time.monotonic,
+                 rng=random.random):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be a positive number of records per second')
+        self.logger_ratios = dict(logger_ratios or {})
+        self.level_ratios = sorted((level_ratios or {}).items())
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate or 0, 1)
+        self.always_keep_level = always_keep_level
+        self.summary_interval = summary_interval
+        self._clock = clock
+        self._random = rng
+        # Ratios by (logger name, level), filled in as records come in.
+        self._ratios = {}
+        # Token buckets by call site: [tokens, last refill time].
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._suppressed = Counter()
+        self._suppressed_loggers = Counter()
+        self._window_start = clock()
+
+    def allow(self, record):
+        levelno = record.levelno
+        if levelno >= self.always_keep_level:
+            return True
+        key = (record.name, levelno)
+        ratio = self._ratios.get(key)
+        if ratio is None:
+            ratio = self._ratios[key] = self._logger_ratio(record.name) * self._level_ratio(levelno)
+        if ratio < 1.0 and self._random() >= ratio:
+            self._suppress(record, 'sampled')
+            return False
+        if self.rate is not None and not self._take_token((record.pathname, record.lineno)):
+            self._suppress(record, 'rate_limited')
+            return False
+        return True
+
+    def take_summary(self):
+        """
+        Returns a record reporting what was suppressed since the last one once
+        `summary_interval` seconds have passed, or None.
+        """
+        now = self._clock()
+        elapsed = now - self._window_start
+        if elapsed < self.summary_interval:
+            return None
+        with self._lock:
+            self._window_start = now
+            suppressed, self._suppressed = self._suppressed, Counter()
+            loggers, self._suppressed_loggers = self._suppressed_loggers, Counter()
+        total = sum(suppressed.values())
+        if not total:
+            return None
+        record = logging.LogRecord(
+            SUMMARY_LOGGER_NAME, logging.WARNING, __file__, 0,
+            'Suppressed %d log events in the last %d seconds', (total, elapsed), None,
+        )
+        record.suppressed = {
+            'total': total,
+            'sampled': suppressed['sampled'],
+            'rate_limited': suppressed['rate_limited'],
+            'loggers': dict(loggers),
+            'window_seconds': elapsed,
+        }
+        return record
+
+    def _logger_ratio(self, name):
+        while True:
+            if name in self.logger_ratios:
+                return self.logger_ratios[name]
+            if '.' not in name:
+                return 1.0
+            name = name.rsplit('.', 1)[0]
+
+    def _level_ratio(self, levelno):
+        ratio = 1.0
+        for level, level_ratio in self.level_ratios:
+            if level > levelno:
+                break
+            ratio = level_ratio
+        return ratio
+
+    def _take_token(self, site):
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(site)
+            if bucket is None:
+                bucket = self._buckets[site] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            return False
+
+    def _suppress(self, record, reason):
+        with self._lock:
+            self._suppressed[reason] += 1
+            self._suppressed_loggers[record.name] += 1
@@ -0,0 +1,152 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import os
+import socketserver
+import threading
+
+from .flusher import FlushWorker
+from .handler import (
+    DEFAULT_HOST, DEFAULT_BUFFER_CAPACITY, DEFAULT_FLUSH_INTERVAL, DEFAULT_CHECK_INTERVAL, DEFAULT_TIMEOUT,
+    DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_LEVEL, DEFAULT_WORKERS, DEFAULT_BATCH_BYTES, _host_url,
+)
+from .pipe import Pipe
+from .uploader import Uploader, _LENGTH
+
+_UnixStreamServer = getattr(socketserver, 'ThreadingUnixStreamServer', None)
+
+
+class Shipper(object):
+    """
+    Uploads the events of every process logging through a `LogtailHandler`
+    with `shipper_address` set, batching them together.
+
+    Meant to run in a single process per host, such as a prefork server's
+    master process: `start` serves from background threads, `serve_forever`
+    from the calling one.
+    """
+    def __init__(self,
+                 source_token,
+                 address,
+                 host=DEFAULT_HOST,
+                 buffer_capacity=DEFAULT_BUFFER_CAPACITY,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 check_interval=DEFAULT_CHECK_INTERVAL,
+                 timeout=DEFAULT_TIMEOUT,
+                 compression=DEFAULT_COMPRESSION,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 workers=DEFAULT_WORKERS,
+                 batch_bytes=DEFAULT_BATCH_BYTES):
+        if _UnixStreamServer is None:
+            raise ValueError('Shipping logs through a shipper requires Unix sockets')
+        if workers < 1:
+            raise ValueError('At least one worker is required')
+        self.address = address
+        self.uploader = Uploader(
+            source_token,
+            _host_url(host),
+            timeout,
+            compression=compression,
+            compression_level=compression_level,
+        )
+        # Connections block once the pipe is full, which slows down the
+        # senders' flush workers rather than dropping events here.
+        self.pipe = Pipe(maxsize=buffer_capacity)
+        self.buffer_capacity = buffer_capacity
+        self.flush_interval = flush_interval
+        self.check_interval = check_interval
+        self.batch_bytes = batch_bytes
+        self.workers = workers
+        self.flush_threads = []
+        self.server = None
+        self._serve_thread = None
+
+    def start(self):
+        self._bind()
+        self._serve_thread = threading.Thread(target=self.server.serve_forever)
+        self._serve_thread.daemon = True
+        self._serve_thread.start()
+
+    def serve_forever(self):
+        self._bind()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def flush(self):
+        for flush_thread in self.flush_threads:
+            if flush_thread.is_alive():
+                flush_thread.flush()
+
+    def close(self):
+        if self.server is None:
+            return
+        if self._serve_thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        _remove_socket(self.address)
+        self.flush()
+        for flush_thread in self.flush_threads:
+            flush_thread.should_run = False
+        self.pipe.wake()
+
+    def _bind(self):
+        # A socket file left behind by a previous shipper would make bind fail.
+        _remove_socket(self.address)
+        self.server = _UnixStreamServer(self.address, _ShipperConnection)
+        self.server.daemon_threads = True
+        self.server.pipe = self.pipe
+        self.flush_threads = [self._start_flush_thread() for _ in range(self.workers)]
+
+    def _start_flush_thread(self):
+        flush_thread = FlushWorker(
+            self.uploader,
+            self.pipe,
+            self.buffer_capacity,
+            self.flush_interval,
+            self.check_interval,
+            new_batch=self.uploader.new_batch,
+            batch_bytes=self.batch_bytes,
+            encoded=True,
+        )
+        flush_thread.start()
+        return flush_thread
+
+
+class _ShipperConnection(socketserver.BaseRequestHandler):
+    def handle(self):
+        rfile = self.request.makefile('rb')
+        while True:
+            body = _read_message(rfile)
+            if body is None:
+                return
+            for data in _split_events(body):
+                self.server.pipe.put(data, nbytes=len(data))
+
+
+def _read_message(rfile):
+    header = rfile.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        return None
+    length, = _LENGTH.unpack(header)
+    body = rfile.read(length)
+    if len(body) < length:
+        return None
+    return body
+
+
+def _split_events(body):
+    offset = 0
+    while offset < len(body):
+        length, = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        yield body[offset:offset + length]
+        offset += length
+
+
+def _remove_socket(address):
+    try:
+        os.unlink(address)
+    except OSError:
+        pass
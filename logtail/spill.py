@@ -0,0 +1,241 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import itertools
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+
+from .compat import fcntl
+
+DEFAULT_SPILL_SEGMENT_BYTES = 8 * 1024 * 1024
+DEFAULT_SPILL_MAX_BYTES = 256 * 1024 * 1024
+
+# Every record is its length followed by the encoded event. Segments are
+# preallocated and zero-filled, so a zero length marks the end of the data.
+# Records acknowledged with `ack` once uploaded get the high bit of their
+# length set so they are not replayed again after a restart.
+_HEADER = struct.Struct('>I')
+_CONSUMED = 0x80000000
+_SUFFIX = '.spill'
+_SLOT_PREFIX = 'slot-'
+_LOCK_NAME = 'lock'
+
+
+class SpillQueue(object):
+    """
+    FIFO of encoded events kept in memory-mapped segment files.
+
+    Queues sharing a directory, such as those of the worker processes of a
+    web server, each lock a slot of their own in it (`path`), holding up to
+    `max_bytes`. A queue taking over a slot a previous process left replays
+    its events. Without `fcntl` (on Windows) the directory is used as is and
+    must not be shared.
+
+    Events returned by `get` stay on disk until acknowledged with `ack`, so
+    those of a batch that was not uploaded yet are replayed after a crash.
+    """
+    def __init__(self, directory, segment_bytes=DEFAULT_SPILL_SEGMENT_BYTES, max_bytes=DEFAULT_SPILL_MAX_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.dropcount = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path, self._lock_file = _claim_slot(directory)
+
+        # Segments left behind by a previous process are replayed first.
+        names = sorted(n for n in os.listdir(self.path) if n.endswith(_SUFFIX))
+        self._next_id = int(names[-1][:-len(_SUFFIX)]) + 1 if names else 0
+        self._segments = deque()
+        # Segments read to the end whose events are not all acknowledged.
+        self._draining = set()
+        self._pending = 0
+        for name in names:
+            segment = _Segment.recover(os.path.join(self.path, name))
+            if segment is not None:
+                self._segments.append(segment)
+                self._pending += segment.pending()
+
+    def __len__(self):
+        return self._pending
+
+    def empty(self):
+        return self._pending == 0
+
+    @property
+    def nbytes(self):
+        return sum(segment.size for segment in self._segments) + sum(segment.size for segment in self._draining)
+
+    def put(self, data):
+        with self._lock:
+            writer = self._segments[-1] if self._segments else None
+            if writer is None or not writer.append(data):
+                size = max(self.segment_bytes, _HEADER.size + len(data))
+                path = os.path.join(self.path, '%020d%s' % (self._next_id, _SUFFIX))
+                self._next_id += 1
+                writer = _Segment.create(path, size)
+                writer.append(data)
+                self._segments.append(writer)
+                self._evict()
+            self._pending += 1
+
+    def get(self):
+        """
+        Returns the oldest event and the receipt to `ack` it with, or None.
+        """
+        with self._lock:
+            while self._segments:
+                segment = self._segments[0]
+                offset, data = segment.pop()
+                if data is not None:
+                    self._pending -= 1
+                    return data, (segment, offset)
+                if segment.writable:
+                    return None
+                self._segments.popleft()
+                if segment.unacked:
+                    self._draining.add(segment)
+                else:
+                    segment.delete()
+            return None
+
+    def ack(self, receipts):
+        """ Marks events returned by `get` as consumed for good. """
+        with self._lock:
+            for segment, offset in receipts:
+                # Segments evicted since are gone already.
+                if segment.map is None:
+                    continue
+                segment.ack(offset)
+                if not segment.unacked and segment in self._draining:
+                    self._draining.discard(segment)
+                    segment.delete()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            for segment in self._draining:
+                segment.close()
+            self._segments.clear()
+            self._draining.clear()
+            self.release()
+
+    def release(self):
+        """
+        Closes this process's handle on the slot's lock, which is held until
+        every process sharing it (after a fork) has done so.
+        """
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _evict(self):
+        # Once over the size cap, the oldest segments are discarded first.
+        while len(self._segments) > 1 and self.nbytes > self.max_bytes:
+            segment = self._segments.popleft()
+            dropped = segment.pending()
+            self._pending -= dropped
+            self.dropcount += dropped
+            segment.delete()
+
+
+def _claim_slot(directory):
+    if fcntl is None:
+        return directory, None
+    for slot in itertools.count():
+        path = os.path.join(directory, '%s%d' % (_SLOT_PREFIX, slot))
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        lock_file = open(os.path.join(path, _LOCK_NAME), 'a+b')
+        try:
+            # Held until the file is closed, or the process exits.
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return path, lock_file
+
+
+class _Segment(object):
+    def __init__(self, path, map_, writable):
+        self.path = path
+        self.map = map_
+        self.size = len(map_)
+        self.read_offset = 0
+        self.write_offset = 0
+        # Records returned by `pop` and not acknowledged yet.
+        self.unacked = 0
+        # Only the segment created by this process is appended to; recovered
+        # ones are read back and deleted.
+        self.writable = writable
+
+    @classmethod
+    def create(cls, path, size):
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            return cls(path, mmap.mmap(f.fileno(), size), True)
+
+    @classmethod
+    def recover(cls, path):
+        with open(path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= _HEADER.size:
+                return cls(path, mmap.mmap(f.fileno(), size), False)
+        os.remove(path)
+        return None
+
+    def append(self, data):
+        end = self.write_offset + _HEADER.size + len(data)
+        if not self.writable or end > self.size:
+            self.writable = False
+            return False
+        # Length is written last so a torn write reads as the end of the data.
+        self.map[self.write_offset + _HEADER.size:end] = data
+        _HEADER.pack_into(self.map, self.write_offset, len(data))
+        self.write_offset = end
+        return True
+
+    def pop(self):
+        for offset, length in self._records():
+            self.unacked += 1
+            start = offset + _HEADER.size
+            return offset, self.map[start:start + length]
+        return None, None
+
+    def ack(self, offset):
+        length, = _HEADER.unpack_from(self.map, offset)
+        _HEADER.pack_into(self.map, offset, length | _CONSUMED)
+        self.unacked -= 1
+
+    def pending(self):
+        offset = self.read_offset
+        count = sum(1 for _ in self._records())
+        self.read_offset = offset
+        return count
+
+    def _records(self):
+        # Yields (offset, length) of the records not consumed yet, advancing
+        # the read offset past each of them.
+        while self.read_offset + _HEADER.size <= self.size:
+            offset = self.read_offset
+            length, = _HEADER.unpack_from(self.map, offset)
+            consumed = length & _CONSUMED
+            length &= ~_CONSUMED
+            if length == 0 or offset + _HEADER.size + length > self.size:
+                return
+            self.read_offset = offset + _HEADER.size + length
+            if not consumed:
+                yield offset, length
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
@@ -0,0 +1,98 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+from bisect import bisect_left
+from collections import Counter
+
+EMIT_SECONDS_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+UPLOAD_SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 5000)
+
+
+class Histogram(object):
+    """ Counts of observed values by upper bound, Prometheus style. """
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets[bound] = total
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Stats(object):
+    """
+    Counters updated by `LogtailHandler` and its flush workers. Updates take
+    no lock, so concurrent ones may very occasionally be lost; that is the
+    price of keeping them cheap on the logging path.
+    """
+    def __init__(self):
+        self.emit_seconds = Histogram(EMIT_SECONDS_BUCKETS)
+        self.upload_seconds = Histogram(UPLOAD_SECONDS_BUCKETS)
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.events_shipped = 0
+        self.bytes_shipped = 0
+        self.retries = 0
+        self.retry_dropped = 0
+        self.failures = Counter()
+        self.network_errors = 0
+
+    def record_upload(self, frame, status_code, seconds, nbytes=None, error=None):
+        """
+        `nbytes` is the size of the request body as sent, after compression
+        (the batch's encoded size by default), and `error` the exception
+        raised if the request could not be made at all.
+        """
+        self.upload_seconds.observe(seconds)
+        if error is not None:
+            self.network_errors += 1
+        elif 200 <= status_code < 300:
+            self.events_shipped += len(frame)
+            self.bytes_shipped += getattr(frame, 'nbytes', 0) if nbytes is None else nbytes
+            self.batch_sizes.observe(len(frame))
+        else:
+            self.failures[status_code] += 1
+
+    def snapshot(self):
+        return {
+            'events_shipped': self.events_shipped,
+            'bytes_shipped': self.bytes_shipped,
+            'retries': self.retries,
+            'retry_dropped': self.retry_dropped,
+            'failures': dict(self.failures),
+            'network_errors': self.network_errors,
+            'batch_size': self.batch_sizes.snapshot(),
+            'upload_seconds': self.upload_seconds.snapshot(),
+            'emit_seconds': self.emit_seconds.snapshot(),
+        }
+
+
+def to_prometheus(stats, prefix='logtail_handler'):
+    """ Renders `LogtailHandler.stats()` in the Prometheus text format. """
+    lines = []
+    for name, value in sorted(stats.items()):
+        metric = '%s_%s' % (prefix, name)
+        if isinstance(value, dict) and 'buckets' in value:
+            lines.append('# TYPE %s histogram' % metric)
+            for bound, count in value['buckets'].items():
+                lines.append('%s_bucket{le="%s"} %s' % (metric, bound, count))
+            lines.append('%s_sum %s' % (metric, value['sum']))
+            lines.append('%s_count %s' % (metric, value['count']))
+        elif isinstance(value, dict):
+            label = 'status_code' if name == 'failures' else 'level'
+            lines.append('# TYPE %s counter' % metric)
+            for key, count in sorted(value.items()):
+                lines.append('%s{%s="%s"} %s' % (metric, label, key, count))
+        else:
+            lines.append('%s %s' % (metric, value))
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,50 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
+import gzip
+import os
+import socket
+import struct
+import threading
+
 import msgpack
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from .compat import httpx, zstd_compress
+
+COMPRESSIONS = ('gzip', 'zstd')
+TRUNCATED_SUFFIX = '... [truncated]'
+
+# Keys every frame has; anything else was added from the record's extras.
+_FRAME_KEYS = ('dt', 'level', 'severity', 'message', 'context')
+_CONTEXT_KEYS = ('runtime', 'system')
+
+# Messages sent to a shipper are a length followed by that many bytes of
+# length-prefixed encoded events.
+_LENGTH = struct.Struct('>I')
+
+# Idle connections are probed so that load balancers and NAT tables don't
+# silently drop them between flushes, which would cost a new TLS handshake.
+KEEPALIVE_IDLE = 30  # seconds
+KEEPALIVE_INTERVAL = 10  # seconds
+KEEPALIVE_PROBES = 3
+
+
+def _keepalive_socket_options():
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # macOS calls TCP_KEEPIDLE TCP_KEEPALIVE; some platforms have neither.
+    idle = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+    for option, value in (
+        (idle, KEEPALIVE_IDLE),
+        (getattr(socket, 'TCP_KEEPINTVL', None), KEEPALIVE_INTERVAL),
+        (getattr(socket, 'TCP_KEEPCNT', None), KEEPALIVE_PROBES),
+    ):
+        if option is not None:
+            options.append((socket.IPPROTO_TCP, option, value))
+    return options
+
 
 class Fake500(object):
     def __init__(self, exception):
@@ -9,19 +52,299 @@ class Fake500(object):
         self.exception = exception
 
 class Uploader(object):
-    def __init__(self, source_token, host, timeout):
+    def __init__(self, source_token, host, timeout, compression=None, compression_level=None, max_event_bytes=None,
+                 pool_size=None, keepalive=True, share_session=False):
         self.source_token = source_token
         self.host = host
         self.timeout = timeout
-        self.session = requests.Session()
+        # Events encoding to more than this many bytes are truncated.
+        self.max_event_bytes = max_event_bytes
+        # Connections kept open to the host; flush workers beyond that many
+        # open a new connection for every request.
+        self.pool_size = pool_size or DEFAULT_POOLSIZE
+        self.keepalive = keepalive
+        # Uploaders with the same host and connection settings can share one
+        # session, so all handlers of a process reuse the same connections.
+        self.share_session = share_session
+        self.session = self._create_session()
         self.headers = {
             'Authorization': 'Bearer %s' % source_token,
             'Content-Type': 'application/msgpack',
         }
+        self.compression = compression
+        self.compression_level = compression_level
+        self._compress = _compressor(compression, compression_level)
+        if compression is not None:
+            self.headers['Content-Encoding'] = compression
+        self._local = threading.local()
+
+    def _create_session(self):
+        if self.share_session:
+            return _shared_session(
+                (type(self), self.host, self.timeout, self.pool_size, self.keepalive), self._new_session,
+            )
+        return self._new_session()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = _PoolAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            socket_options=_keepalive_socket_options() if self.keepalive else None,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def warm_up(self):
+        """
+        Opens a connection to the host ahead of the first batch, so it doesn't
+        wait for the TCP and TLS handshakes. Failures are left to the upload.
+        """
+        try:
+            self.session.head(self.host, timeout=self.timeout)
+        except requests.RequestException:
+            pass
+
+    def _reset_after_fork(self):
+        # Connections inherited from the parent process are still in use there.
+        self.session = self._create_session()
+        self._local = threading.local()
+
+    def new_batch(self):
+        return Batch(self._packer(), self.max_event_bytes)
+
+    def encode(self, event):
+        return _pack_event(self._packer(), event, self.max_event_bytes)
+
+    def _packer(self):
+        # Packers are reused across batches but not shared between threads.
+        packer = getattr(self._local, 'packer', None)
+        if packer is None:
+            packer = self._local.packer = msgpack.Packer(use_bin_type=True)
+        return packer
+
+    def payload(self, frame):
+        if isinstance(frame, Batch):
+            data = frame.payload()
+        else:
+            data = msgpack.packb(frame, use_bin_type=True)
+        if self._compress is not None:
+            data = self._compress(data)
+        self._local.payload_bytes = len(data)
+        return data
+
+    def payload_bytes(self):
+        """ Size of the last payload built by the calling thread, as sent. """
+        return getattr(self._local, 'payload_bytes', None)
 
     def __call__(self, frame):
-        data = msgpack.packb(frame, use_bin_type=True)
+        data = self.payload(frame)
         try:
             return self.session.post(self.host, data=data, headers=self.headers, timeout=self.timeout)
         except requests.RequestException as e:
             return Fake500(e)
+
+
+class SocketUploader(Uploader):
+    """
+    Uploader handing batches over to a `Shipper` through a Unix socket
+    instead of posting them to Better Stack.
+    """
+    def __init__(self, address, max_event_bytes=None):
+        Uploader.__init__(self, None, address, None, max_event_bytes=max_event_bytes)
+        self.address = address
+
+    def _create_session(self):
+        return None
+
+    def __call__(self, frame):
+        if isinstance(frame, Batch):
+            events = frame.encoded_events()
+        else:
+            events = [self.encode(event) for event in frame]
+        body = b''.join(_LENGTH.pack(len(data)) + data for data in events)
+        self._local.payload_bytes = _LENGTH.size + len(body)
+        try:
+            self._socket().sendall(_LENGTH.pack(len(body)) + body)
+        except OSError as e:
+            # Reconnect for the next batch, which may go to a restarted shipper.
+            self._close_socket()
+            return Fake500(e)
+        return _Delivered()
+
+    def warm_up(self):
+        try:
+            self._socket()
+        except OSError:
+            pass
+
+    def _socket(self):
+        # Each flush worker gets its own connection, so messages never interleave.
+        sock = getattr(self._local, 'socket', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+            except OSError:
+                sock.close()
+                raise
+            self._local.socket = sock
+        return sock
+
+    def _close_socket(self):
+        sock = getattr(self._local, 'socket', None)
+        if sock is not None:
+            self._local.socket = None
+            sock.close()
+
+
+class HTTP2Uploader(Uploader):
+    """
+    Uploader posting batches with httpx over HTTP/2, which multiplexes the
+    requests of all flush workers on one connection.
+    """
+    def _new_session(self):
+        if httpx is None:
+            raise ImportError('HTTP/2 requires the httpx package with the http2 extra')
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        transport = httpx.HTTPTransport(
+            http2=True,
+            limits=limits,
+            socket_options=_keepalive_socket_options() if self.keepalive else None,
+        )
+        return httpx.Client(transport=transport, timeout=self.timeout)
+
+    def warm_up(self):
+        try:
+            self.session.head(self.host)
+        except httpx.HTTPError:
+            pass
+
+    def __call__(self, frame):
+        data = self.payload(frame)
+        try:
+            return self.session.post(self.host, content=data, headers=self.headers)
+        except httpx.HTTPError as e:
+            return Fake500(e)
+
+
+class _PoolAdapter(HTTPAdapter):
+    def __init__(self, socket_options=None, **kwargs):
+        # Read by `init_poolmanager`, which the base class calls.
+        self._socket_options = socket_options
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._socket_options is not None:
+            kwargs['socket_options'] = self._socket_options
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+
+def _shared_session(key, create):
+    with _shared_sessions_lock:
+        session = _shared_sessions.get(key)
+        if session is None:
+            session = _shared_sessions[key] = create()
+        return session
+
+
+def _forget_shared_sessions():
+    # Their connections belong to the parent process. Uploaders create new
+    # sessions in `_reset_after_fork`, which runs after this.
+    global _shared_sessions_lock
+    _shared_sessions.clear()
+    _shared_sessions_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_shared_sessions)
+
+
+class _Delivered(object):
+    status_code = 202
+
+
+def _compressor(compression, level):
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        level = 6 if level is None else level
+        return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    if compression == 'zstd':
+        if zstd_compress is None:
+            raise ValueError(
+                'zstd compression requires Python 3.14+ or the zstandard package'
+            )
+        return lambda data: zstd_compress(data, level=level)
+    raise ValueError(
+        'Unsupported compression %r, expected one of: %s' % (compression, ', '.join(COMPRESSIONS))
+    )
+
+
+class Batch(object):
+    """ Events encoded one by one as they are added, sent as a msgpack array. """
+    def __init__(self, packer, max_event_bytes=None):
+        self._packer = packer
+        self._max_event_bytes = max_event_bytes
+        self._events = []
+        # Encoded size of the events, kept up to date as they are added so
+        # batches can be sized by bytes without encoding them again.
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def append(self, event):
+        self.append_encoded(_pack_event(self._packer, event, self._max_event_bytes))
+
+    def append_encoded(self, data):
+        self._events.append(data)
+        self.nbytes += len(data)
+
+    def encoded_events(self):
+        return list(self._events)
+
+    def payload(self):
+        header = self._packer.pack_array_header(len(self._events))
+        return header + b''.join(self._events)
+
+
+def _pack_event(packer, event, max_event_bytes):
+    data = packer.pack(event)
+    if max_event_bytes is None or len(data) <= max_event_bytes:
+        return data
+    return packer.pack(_truncate_event(packer, event, max_event_bytes))
+
+
+def _truncate_event(packer, event, max_event_bytes):
+    # Shrinks the largest parts of the event first: the message is shortened
+    # to what fits, custom fields are dropped whole. The frame's own fields
+    # are kept, so the event may still be over the limit if it is tiny.
+    event = dict(event)
+    parts = [(event, key) for key in event if key not in _FRAME_KEYS or key == 'message']
+    context = event.get('context')
+    if isinstance(context, dict):
+        context = event['context'] = dict(context)
+        parts.extend((context, key) for key in context if key not in _CONTEXT_KEYS)
+    parts.sort(key=lambda part: len(packer.pack(part[0][part[1]])), reverse=True)
+    event['logtail_truncated'] = True
+
+    size = len(packer.pack(event))
+    for container, key in parts:
+        if size <= max_event_bytes:
+            break
+        if container is event and key == 'message' and isinstance(event[key], str):
+            # Every character takes at least one byte, so removing as many
+            # characters as there are excess bytes is always enough.
+            message = event[key]
+            keep = max(len(message) - (size - max_event_bytes) - len(TRUNCATED_SUFFIX), 0)
+            event[key] = message[:keep] + TRUNCATED_SUFFIX
+        else:
+            del container[key]
+        size = len(packer.pack(event))
+    return event
@@ -27,6 +27,13 @@ setup(
     download_url='https://github.com/logtail/logtail-python/tarball/%s' % (VERSION),
     keywords=['api', 'logtail', 'logging', 'client'],
     install_requires=REQUIREMENTS,
+    extras_require={
+        'zstd': ['zstandard>=0.18.0; python_version < "3.14"'],
+        'aio': ['aiohttp>=3.8'],
+        'http2': ['httpx[http2]>=0.25'],
+        'orjson': ['orjson>=3.6'],
+        'ujson': ['ujson>=5.4'],
+    },
     python_requires='>=3.10',
     author='Logtail',
     author_email='hello@logtail.com',
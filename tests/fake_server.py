@@ -0,0 +1,81 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import random
+import threading
+import time
+from datetime import datetime
+
+import msgpack
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    ThreadingHTTPServer = None
+
+
+class FakeIngestServer(object):
+    """
+    Local stand-in for the ingestion endpoint with injectable latency and
+    error rate, used by the tests and the end-to-end benchmarks.
+
+    Requests fail with a 503 at `error_rate`, drawn from a generator seeded
+    with `seed` so runs are reproducible. Events of uncompressed requests
+    which succeed are kept in `events`, and with `track_lag` the time between
+    each event's `dt` and its arrival is kept in `lags`.
+    """
+    def __init__(self, latency=0, status_code=202, error_rate=0.0, seed=0, track_lag=False):
+        self.latency = latency
+        self.status_code = status_code
+        self.error_rate = error_rate
+        self.track_lag = track_lag
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.events = []
+        self.lags = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._request_handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _request_handler(self):
+        fake = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                body = self.rfile.read(length)
+                received = time.time()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.lock:
+                    failed = fake.random.random() < fake.error_rate
+                    fake.requests += 1
+                    fake.bytes += length
+                    fake.errors += failed
+                    if not failed and 'Content-Encoding' not in self.headers:
+                        events = msgpack.unpackb(body, raw=False)
+                        fake.events.extend(events)
+                        if fake.track_lag:
+                            fake.lags.extend(received - datetime.fromisoformat(e['dt']).timestamp() for e in events)
+                self.send_response(503 if failed else fake.status_code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return RequestHandler
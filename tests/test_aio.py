@@ -0,0 +1,137 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import asyncio
+import logging
+import mock
+import unittest
+
+from logtail.compat import aiohttp
+
+from .fake_server import FakeIngestServer
+
+if aiohttp is not None:
+    from logtail.aio import AsyncLogtailHandler, AsyncUploader
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncLogtailHandler(unittest.TestCase):
+    source_token = 'dummy_source_token'
+
+    def _logger(self, handler):
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        return logger
+
+    def test_flushes_on_running_loop(self):
+        with FakeIngestServer() as server:
+            handler = AsyncLogtailHandler(source_token=self.source_token, host=server.url, buffer_capacity=3)
+            logger = self._logger(handler)
+
+            async def main():
+                for i in range(7):
+                    logger.critical('event %d', i)
+                self.assertIs(handler.loop, asyncio.get_running_loop())
+                await handler.aflush()
+                await handler.uploader.close()
+
+            asyncio.run(main())
+
+        self.assertEqual(sorted(e['message'] for e in server.events), ['event %d' % i for i in range(7)])
+        self.assertEqual(server.requests, 3)
+        self.assertIsNone(handler._loop_thread)
+
+    def test_flushes_on_dedicated_loop_thread(self):
+        with FakeIngestServer() as server:
+            handler = AsyncLogtailHandler(source_token=self.source_token, host=server.url, flush_interval=0.05)
+            logger = self._logger(handler)
+            logger.critical('hello', extra={'data': {'id': 1}})
+            self.assertIsNotNone(handler._loop_thread)
+
+            handler.flush()
+            self.assertEqual(server.events[0]['message'], 'hello')
+            self.assertEqual(server.events[0]['data'], {'id': 1})
+            handler.close()
+        self.assertIsNone(handler._loop_thread)
+
+    def test_flush_from_the_loop_before_the_flush_task_starts(self):
+        with FakeIngestServer() as server:
+            handler = AsyncLogtailHandler(source_token=self.source_token, host=server.url)
+            logger = self._logger(handler)
+
+            async def main():
+                logger.critical('hello')
+                # Only schedules the flush; waiting for it here would block the loop.
+                handler.flush()
+                await handler.aflush()
+                await handler.uploader.close()
+
+            asyncio.run(asyncio.wait_for(main(), 5))
+
+        self.assertEqual([e['message'] for e in server.events], ['hello'])
+
+    def test_close_sends_events_left_behind_by_asyncio_run(self):
+        with FakeIngestServer(latency=0.3) as server:
+            handler = AsyncLogtailHandler(source_token=self.source_token, host=server.url, buffer_capacity=2)
+            logger = self._logger(handler)
+
+            async def main():
+                # Both batches are being uploaded when the loop shuts down, and
+                # the last event is still pending.
+                for i in range(3):
+                    logger.critical('event %d', i)
+                await asyncio.sleep(0.1)
+                logger.critical('event 3')
+
+            asyncio.run(main())
+            self.assertIsNone(handler.uploader.session)
+            self.assertEqual(len(handler._unsent), 2)
+            self.assertEqual(len(handler.pending), 1)
+            handler.close()
+
+        # Interrupted uploads are sent again, whether or not they got through.
+        self.assertEqual({e['message'] for e in server.events}, {'event %d' % i for i in range(4)})
+        self.assertFalse(handler.pending)
+        self.assertFalse(handler._unsent)
+        self.assertIsNone(handler.uploader.session)
+
+    def test_retries_failed_batches(self):
+        handler = AsyncLogtailHandler(source_token=self.source_token, retry_schedule=(0, 0))
+        responses = [mock.Mock(status_code=503), mock.Mock(status_code=202)]
+
+        async def upload(batch):
+            return responses.pop(0)
+        handler.uploader = mock.Mock(side_effect=upload, new_batch=list)
+
+        async def main():
+            self._logger(handler).critical('hello')
+            await handler.aflush()
+
+        asyncio.run(main())
+        self.assertEqual(handler.uploader.call_count, 2)
+
+    def test_drops_events_beyond_max_pending(self):
+        handler = AsyncLogtailHandler(source_token=self.source_token, buffer_capacity=2, max_pending_batches=1)
+        handler.ensure_flush_task_running = mock.Mock()
+        logger = self._logger(handler)
+        for i in range(5):
+            logger.critical('event %d', i)
+
+        self.assertEqual(len(handler.pending), 2)
+        self.assertEqual(handler.dropcount, 3)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncUploader(unittest.TestCase):
+    def test_returns_fake_500_on_connection_errors(self):
+        uploader = AsyncUploader('dummy_source_token', 'http://127.0.0.1:1', 1)
+
+        async def main():
+            try:
+                return await uploader([{'message': 'hello'}])
+            finally:
+                await uploader.close()
+
+        response = asyncio.run(main())
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNotNone(response.exception)
@@ -1,6 +1,9 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
 import mock
+import msgpack
+import shutil
+import tempfile
 import time
 import threading
 import unittest
@@ -9,7 +12,9 @@ from unittest.mock import patch
 
 from logtail.compat import queue
 from logtail.flusher import RETRY_SCHEDULE
-from logtail.flusher import FlushWorker
+from logtail.flusher import FlushWorker, AdaptiveBatching
+from logtail.pipe import Pipe
+from logtail.spill import SpillQueue
 from logtail.uploader import Uploader
 
 
@@ -98,8 +103,7 @@ class TestFlushWorker(unittest.TestCase):
         fw.step()
         self.assertFalse(uploader.called)
 
-    @patch('logtail.flusher.time.sleep')
-    def test_retries_according_to_schedule(self, mock_sleep):
+    def test_retries_according_to_schedule(self):
         first_frame = list(range(self.buffer_capacity))
 
         self.uploader_calls = 0
@@ -108,20 +112,127 @@ class TestFlushWorker(unittest.TestCase):
             self.assertEqual(frame, first_frame)
             return mock.MagicMock(status_code=500)
 
-        self.sleep_calls = 0
-        def sleep(time):
-            self.assertEqual(time, RETRY_SCHEDULE[self.sleep_calls])
-            self.sleep_calls += 1
-        mock_sleep.side_effect = sleep
-
         pipe, _, fw = self._setup_worker(uploader)
+        fw.retry_jitter = 0
 
         for log in first_frame:
             pipe.put(log, block=False)
 
         fw.step()
+        for delay in RETRY_SCHEDULE:
+            self.assertEqual(len(fw._retries), 1)
+            retry = fw._retries[0]
+            self.assertAlmostEqual(retry.deadline - time.time(), delay, places=1)
+            retry.deadline = 0
+            fw._send_due_retries()
+
         self.assertEqual(self.uploader_calls, len(RETRY_SCHEDULE) + 1)
-        self.assertEqual(self.sleep_calls, len(RETRY_SCHEDULE))
+        self.assertEqual(fw._retries, [])
+        self.assertEqual(fw._retry_bytes, 0)
+
+    def test_applies_jitter_to_retry_delays(self):
+        _, _, fw = self._setup_worker(lambda frame: mock.MagicMock(status_code=503))
+        fw.retry_schedule = (10, )
+        fw.retry_jitter = 0.5
+
+        with patch('logtail.flusher.random.uniform', return_value=-0.5) as uniform:
+            fw._send([1])
+        uniform.assert_called_with(-0.5, 0.5)
+        self.assertAlmostEqual(fw._retries[0].deadline - time.time(), 5, places=1)
+
+    @patch('logtail.flusher.time.sleep')
+    def test_sends_fresh_batches_while_retrying(self, sleep):
+        self.uploads = []
+        def uploader(frame):
+            self.uploads.append(list(frame))
+            return mock.MagicMock(status_code=500 if len(self.uploads) == 1 else 202)
+
+        pipe, _, fw = self._setup_worker(uploader)
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+
+        pipe.put('failing', block=False)
+        fw.step()
+        self.assertEqual(len(fw._retries), 1)
+        self.assertTrue(fw.should_run)
+        self.assertTrue(sleep.called)
+
+        pipe.put('fresh', block=False)
+        fw.step()
+        self.assertEqual(self.uploads, [['failing'], ['fresh']])
+        self.assertEqual(len(fw._retries), 1)
+
+        fw._retries[0].deadline = 0
+        fw.step()
+        self.assertEqual(self.uploads, [['failing'], ['fresh'], ['failing']])
+        self.assertEqual(fw._retries, [])
+        self.assertFalse(fw.should_run)
+
+    def test_drops_oldest_batches_when_retry_buffer_is_full(self):
+        _, _, fw = self._setup_worker(lambda frame: mock.MagicMock(status_code=500))
+        fw.max_retry_bytes = self.buffer_capacity
+
+        first_frame = list(range(self.buffer_capacity))
+        second_frame = list(range(self.buffer_capacity, 2 * self.buffer_capacity))
+        fw._send(first_frame)
+        fw._send(second_frame)
+
+        self.assertEqual([r.frame for r in fw._retries], [second_frame])
+        self.assertEqual(fw._retry_bytes, self.buffer_capacity)
+
+    def test_prepares_entries_and_skips_discarded_ones(self):
+        self.uploaded = None
+        def uploader(frame):
+            self.uploaded = frame
+            return mock.MagicMock(status_code=202)
+
+        pipe, _, fw = self._setup_worker(uploader)
+        fw.prepare = lambda entry: None if entry % 2 else entry * 10
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+
+        for i in range(self.buffer_capacity):
+            pipe.put(i, block=False)
+
+        fw.step()
+        self.assertEqual(self.uploaded, [0, 20, 40])
+
+    def test_coalesces_repeated_entries(self):
+        self.uploaded = None
+        def uploader(frame):
+            self.uploaded = frame
+            return mock.MagicMock(status_code=202)
+
+        pipe, _, fw = self._setup_worker(uploader)
+        fw.prepare = lambda entry: {'message': entry[0]}
+        fw.coalesce = lambda entry: (entry[0], entry[1]) if entry[0] != 'unique' else None
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+
+        for entry in [('retrying', 0), ('unique', 1), ('retrying', 2), ('other', 3), ('retrying', 4)]:
+            pipe.put(entry, block=False)
+
+        fw.step()
+        self.assertEqual(self.uploaded, [
+            {'message': 'unique'},
+            {'message': 'retrying', 'repeat_count': 3,
+             'first_dt': '1970-01-01T00:00:00+00:00', 'last_dt': '1970-01-01T00:00:04+00:00'},
+            {'message': 'other'},
+        ])
+
+    def test_starts_over_once_the_coalesce_window_is_over(self):
+        self.uploaded = None
+        def uploader(frame):
+            self.uploaded = frame
+            return mock.MagicMock(status_code=202)
+
+        pipe, _, fw = self._setup_worker(uploader)
+        fw.prepare = lambda entry: {'message': entry}
+        fw.coalesce = lambda entry: (entry, 0)
+        fw.coalesce_window = 0
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+        pipe.put('retrying', block=False)
+        pipe.put('retrying', block=False)
+
+        fw.step()
+        self.assertEqual(self.uploaded, [{'message': 'retrying'}, {'message': 'retrying'}])
 
     def test_shutdown_condition_empties_queue_and_shuts_down(self):
         self.buffer_capacity = 10
@@ -190,3 +301,228 @@ class TestFlushWorker(unittest.TestCase):
         self.assertFalse(threading.excepthook.called)
 
         threading.excepthook = original_excepthook
+
+    def test_encodes_events_into_uploader_batches(self):
+        uploader = Uploader(self.source_token, self.host, self.timeout)
+        self.payloads = []
+        def upload(frame):
+            self.payloads.append(frame.payload())
+            return mock.MagicMock(status_code=202)
+
+        pipe = queue.Queue(maxsize=self.buffer_capacity)
+        fw = FlushWorker(upload, pipe, self.buffer_capacity, self.flush_interval, self.check_interval, new_batch=uploader.new_batch)
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+
+        pipe.put({'message': 'hello'}, block=False)
+        pipe.put({'message': object()}, block=False)
+        pipe.put({'message': 'goodbye'}, block=False)
+
+        fw.step()
+        self.assertEqual(len(self.payloads), 1)
+        self.assertEqual(msgpack.unpackb(self.payloads[0], raw=False), [{'message': 'hello'}, {'message': 'goodbye'}])
+
+    def test_appends_encoded_entries_as_they_are(self):
+        uploader = Uploader(self.source_token, self.host, self.timeout)
+        self.payloads = []
+        def upload(frame):
+            self.payloads.append(frame.payload())
+            return mock.MagicMock(status_code=202)
+
+        pipe = queue.Queue(maxsize=self.buffer_capacity)
+        fw = FlushWorker(upload, pipe, self.buffer_capacity, self.flush_interval, self.check_interval,
+                         new_batch=uploader.new_batch, encoded=True)
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+        pipe.put(uploader.encode({'message': 'hello'}), block=False)
+        pipe.put(uploader.encode({'message': 'goodbye'}), block=False)
+
+        fw.step()
+        self.assertEqual(msgpack.unpackb(self.payloads[0], raw=False), [{'message': 'hello'}, {'message': 'goodbye'}])
+
+    def test_sends_batches_once_they_reach_batch_bytes(self):
+        uploader = Uploader(self.source_token, self.host, self.timeout)
+        self.batches = []
+        def upload(frame):
+            self.batches.append(len(frame))
+            return mock.MagicMock(status_code=202)
+
+        pipe = queue.Queue(maxsize=self.buffer_capacity)
+        event_bytes = len(uploader.encode({'message': 'x' * 100}))
+        fw = FlushWorker(upload, pipe, self.buffer_capacity, 1000, self.check_interval,
+                         new_batch=uploader.new_batch, batch_bytes=2 * event_bytes)
+        for _ in range(self.buffer_capacity):
+            pipe.put({'message': 'x' * 100}, block=False)
+
+        t1 = time.time()
+        fw.step()
+        fw.step()
+        self.assertLess(time.time() - t1, 1)
+        self.assertEqual(self.batches, [2, 2])
+        self.assertEqual(pipe.qsize(), 1)
+
+    def test_drains_spilled_events_before_the_pipe(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spill = SpillQueue(directory)
+        spill.put(msgpack.packb('spilled 1'))
+        spill.put(msgpack.packb('spilled 2'))
+
+        self.uploaded = None
+        def uploader(frame):
+            self.uploaded = frame
+            return mock.MagicMock(status_code=202)
+
+        pipe, _, fw = self._setup_worker(uploader)
+        fw.spill = spill
+        pipe.put('queued', block=False)
+        fw.flush_interval = 0.2
+
+        fw.step()
+        self.assertEqual(self.uploaded, ['spilled 1', 'spilled 2', 'queued'])
+        self.assertTrue(spill.empty())
+        spill.close()
+
+    def test_keeps_spilled_events_on_disk_until_their_batch_is_sent(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spill = SpillQueue(directory)
+        spill.put(msgpack.packb('spilled'))
+
+        self.status_code = 503
+        pipe, _, fw = self._setup_worker(lambda frame: mock.MagicMock(status_code=self.status_code))
+        fw.spill = spill
+        fw.flush_interval = 0.1
+        fw.retry_schedule = (60,)
+        fw.step()
+        self.assertEqual(len(fw._retries), 1)
+
+        # Were the process killed now, the next one to take over its slot
+        # would replay the event.
+        spill.release()
+        replayed = SpillQueue(directory)
+        self.assertEqual(len(replayed), 1)
+        replayed.close()
+
+        self.status_code = 202
+        fw._retries[0].deadline = 0
+        fw.step()
+        self.assertEqual(fw._retries, [])
+        spill.close()
+        self.assertTrue(SpillQueue(directory).empty())
+
+    def test_spills_batches_over_the_retry_buffer_cap(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spill = SpillQueue(directory)
+
+        _, _, fw = self._setup_worker(lambda frame: mock.MagicMock(status_code=500))
+        fw.spill = spill
+        fw.max_retry_bytes = 2
+        fw._send(['first', 'second'])
+        fw._send(['third', 'fourth'])
+
+        self.assertEqual([r.frame for r in fw._retries], [['third', 'fourth']])
+        self.assertIsNone(fw._get_spilled(shutdown=False))
+
+        fw._retries = []
+        self.assertEqual(msgpack.unpackb(fw._get_spilled(shutdown=False)[0], raw=False), 'first')
+        self.assertEqual(msgpack.unpackb(fw._get_spilled(shutdown=False)[0], raw=False), 'second')
+        spill.close()
+
+    def test_flush_wakes_up_worker_waiting_on_pipe(self):
+        self.flush_interval = 60
+        self.uploaded = []
+        def uploader(frame):
+            self.uploaded.append(frame)
+            return mock.MagicMock(status_code=202)
+
+        pipe = Pipe(maxsize=self.buffer_capacity)
+        fw = FlushWorker(uploader, pipe, self.buffer_capacity, self.flush_interval, 1)
+        fw.start()
+        self.addCleanup(fw.join)
+        self.addCleanup(pipe.wake)
+        self.addCleanup(setattr, fw, 'parent_thread', mock.MagicMock(is_alive=lambda: False))
+        pipe.put('hello')
+
+        start = time.time()
+        fw.flush()
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(self.uploaded, [['hello']])
+
+    def test_warms_up_before_the_first_batch(self):
+        calls = []
+        def uploader(frame):
+            calls.append('upload')
+            return mock.MagicMock(status_code=202)
+
+        pipe = Pipe(maxsize=self.buffer_capacity)
+        pipe.put('hello')
+        fw = FlushWorker(uploader, pipe, self.buffer_capacity, self.flush_interval, self.check_interval,
+                         warm_up=lambda: calls.append('warm up'))
+        fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+        fw.start()
+        fw.join()
+        self.assertEqual(calls, ['warm up', 'upload'])
+
+    def test_adaptive_batches_are_sized_by_observed_limits(self):
+        self.uploaded = []
+        def uploader(frame):
+            self.uploaded.append(len(frame))
+            return mock.MagicMock(status_code=202)
+
+        adaptive = mock.MagicMock()
+        adaptive.update.return_value = (5, 60)
+        pipe = Pipe(maxsize=20)
+        for i in range(12):
+            pipe.put(i)
+        fw = FlushWorker(uploader, pipe, 2, self.flush_interval, self.check_interval, adaptive=adaptive)
+        fw.step()
+        fw.step()
+        self.assertEqual(self.uploaded, [5, 5])
+        adaptive.observe_events.assert_called_with(5, behind=True)
+        self.assertEqual(adaptive.observe_upload.call_count, 2)
+
+
+class TestAdaptiveBatching(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.adaptive = AdaptiveBatching(10, 1000, 1, min_interval=0.1, smoothing=1, clock=lambda: self.now)
+
+    def cycle(self, events, seconds):
+        self.now += seconds
+        self.adaptive.observe_events(events)
+        return self.adaptive.update()
+
+    def test_starts_at_the_lower_bounds(self):
+        self.assertEqual(self.adaptive.update(), (10, 1))
+
+    def test_grows_batches_with_the_arrival_rate(self):
+        self.adaptive.update()
+        self.assertEqual(self.cycle(500, 1), (500, 1))
+        self.assertEqual(self.cycle(5000, 1), (1000, 1))
+        self.assertEqual(self.cycle(2, 1), (10, 1))
+
+    def test_uploads_shorten_the_interval(self):
+        self.adaptive.update()
+        self.adaptive.observe_upload(0.25)
+        self.assertEqual(self.cycle(400, 1), (300, 0.75))
+
+    def test_batches_hold_what_arrives_during_two_uploads(self):
+        self.adaptive.update()
+        self.adaptive.observe_upload(2)
+        self.assertEqual(self.cycle(100, 1), (400, 0.1))
+
+    def test_doubles_batches_while_falling_behind(self):
+        self.adaptive.update()
+        self.assertEqual(self.cycle(10, 1), (10, 1))
+        self.now += 1
+        self.adaptive.observe_events(10, behind=True)
+        self.assertEqual(self.adaptive.update(), (20, 1))
+        self.now += 1
+        self.adaptive.observe_events(20, behind=True)
+        self.assertEqual(self.adaptive.update(), (40, 1))
+
+    def test_rejects_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            AdaptiveBatching(10, 5, 1)
+        with self.assertRaises(ValueError):
+            AdaptiveBatching(10, 100, 1, min_interval=2)
@@ -1,14 +1,18 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
+import datetime
+import gc
 import mock
 import time
 import threading
 import json
 import unittest
+import weakref
 import pdb
 import logging
 
 import logtail
+from logtail.compat import orjson
 from logtail.formatter import LogtailFormatter
 from logtail.helpers import LogtailContext
 
@@ -102,6 +106,73 @@ class TestLogtailFormatter(unittest.TestCase):
         self.assertEqual(frame['message'], 'goodbye')
         self.assertEqual(frame['context']['data'], {'not_encodable': '<Dummy instance>'})
 
+    def test_format_matches_json_dumps(self):
+        def default(obj):
+            return repr(obj)
+
+        formatter = LogtailFormatter(context=self.context, json_default=default)
+        record = make_record({'order': self.order, 'dummy': Dummy()})
+        frame = logtail.formatter.create_frame(record, record.getMessage(), self.context, include_extra_attributes=True)
+        self.assertEqual(formatter.format(record), json.dumps(frame, default=default))
+
+    def test_format_shared_by_handlers_builds_frame_once(self):
+        formatter = LogtailFormatter(context=self.context)
+        logger, first = logger_and_lines(formatter)
+        second = ListHandler()
+        second.setFormatter(formatter)
+        logger.addHandler(second)
+
+        with mock.patch('logtail.formatter.create_frame', wraps=logtail.formatter.create_frame) as create_frame:
+            logger.info('first')
+            logger.info('second')
+        self.assertEqual(create_frame.call_count, 2)
+        self.assertEqual(first, second.lines)
+
+    def test_format_does_not_keep_the_last_record_alive(self):
+        formatter = LogtailFormatter(context=self.context)
+        record = make_record({'order': self.order})
+        formatter.format(record)
+        ref = weakref.ref(record)
+        del record
+        gc.collect()
+        self.assertIsNone(ref())
+
+    @unittest.skipIf(orjson is None, 'orjson is not available')
+    def test_orjson_serializer_calls_json_default_like_json(self):
+        def default(obj):
+            return 'encoded %s' % type(obj).__name__
+
+        extra = {'order': self.order, 'when': datetime.datetime(2024, 1, 2), 'dummy': Dummy(), 'ids': {1: 'one'}}
+        record = make_record(extra)
+        expected = json.loads(LogtailFormatter(context=self.context, json_default=default).format(record))
+        fast = LogtailFormatter(context=self.context, json_default=default, serializer='orjson')
+        self.assertEqual(json.loads(fast.format(record)), expected)
+
+        with self.assertRaises(TypeError):
+            LogtailFormatter(context=self.context, serializer='orjson').format(make_record({'dummy': Dummy()}))
+
+    @unittest.skipIf(orjson is None, 'orjson is not available')
+    def test_orjson_serializer_falls_back_to_json(self):
+        record = make_record({'big': 2 ** 70})
+        expected = LogtailFormatter(context=self.context).format(record)
+        fast = LogtailFormatter(context=self.context, serializer='orjson')
+        self.assertEqual(fast.format(record), expected)
+
+    def test_rejects_invalid_serializers(self):
+        with self.assertRaises(ValueError):
+            LogtailFormatter(serializer='pickle')
+        with self.assertRaises(ValueError):
+            LogtailFormatter(serializer='ujson', json_encoder=DummyCapableEncoder)
+        with mock.patch('logtail.formatter.ujson', None):
+            with self.assertRaises(ImportError):
+                LogtailFormatter(serializer='ujson')
+
+
+def make_record(extra):
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'hello', None, None)
+    record.__dict__.update(extra)
+    return record
+
 
 class Dummy(object):
     """ Because this is a custom class, it cannot be encoded by the default JSONEncoder. """
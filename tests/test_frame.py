@@ -1,9 +1,10 @@
 # coding: utf-8
 
-from logtail.frame import create_frame
+from logtail.frame import create_frame, create_compact_event
 from logtail.handler import LogtailHandler
 from logtail.helpers import LogtailContext
 import datetime
+import json
 import unittest
 import logging
 
@@ -36,3 +37,70 @@ class TestLogtailLogEntry(unittest.TestCase):
 
         frame = create_frame(log_record, log_record.getMessage(), LogtailContext(), include_extra_attributes=True)
         self.assertIn('non_dict_key', frame)
+
+    def test_create_frame_serializable_matches_json_round_trip(self):
+        log_record = logging.LogRecord("logtail-test", 20, "/some/path", 10, "Some log message", [], None)
+        circular = {'egg': {}}
+        circular['egg']['chicken'] = circular
+        extra = {
+            'data': {
+                'tuple': (1, 'two', 3.0),
+                'set': {'only'},
+                'date': datetime.date(2024, 1, 2),
+                'bytes': b'raw',
+                'keys': {1: 'int', 2.5: 'float', None: 'none', False: 'bool'},
+                'object': object(),
+            },
+            'circular': circular,
+        }
+        log_record.__dict__.update(extra)
+
+        frame = create_frame(log_record, log_record.getMessage(), LogtailContext(), include_extra_attributes=True, serializable=True)
+        expected = json.loads(json.dumps(create_frame(log_record, log_record.getMessage(), LogtailContext(), include_extra_attributes=True), default=str))
+        self.assertEqual(frame, expected)
+        self.assertEqual(frame['circular']['egg']['chicken'], "<omitted circular reference>")
+
+    def test_create_frame_keeps_shared_references_and_omits_cycles(self):
+        log_record = logging.LogRecord("logtail-test", 20, "/some/path", 10, "Some log message", [], None)
+        shared = {'id': 1}
+        nested = current = {}
+        for _ in range(50):
+            current['child'] = {'shared': shared}
+            current = current['child']
+        current['parent'] = nested
+        log_record.__dict__.update({'data': {'a': shared, 'b': [shared, shared]}, 'nested': nested})
+
+        frame = create_frame(log_record, log_record.getMessage(), LogtailContext())
+        self.assertEqual(frame['data'], {'a': {'id': 1}, 'b': [{'id': 1}, {'id': 1}]})
+        current = frame['nested']
+        for _ in range(50):
+            current = current['child']
+            self.assertEqual(current['shared'], {'id': 1})
+        self.assertEqual(current['parent'], "<omitted circular reference>")
+
+    def test_create_frame_reuses_call_site_and_process_metadata(self):
+        first = logging.LogRecord("logtail-test", 20, "/some/path", 10, "first", [], None)
+        second = logging.LogRecord("logtail-test", 20, "/some/path", 10, "second", [], None)
+        first_frame = create_frame(first, first.getMessage(), LogtailContext())
+        second_frame = create_frame(second, second.getMessage(), LogtailContext())
+
+        self.assertEqual(first_frame['context']['runtime'], second_frame['context']['runtime'])
+        self.assertIsNot(first_frame['context']['runtime'], second_frame['context']['runtime'])
+        self.assertIs(first_frame['context']['system'], second_frame['context']['system'])
+
+        # Records of another process, e.g. a forked child, get their own.
+        second.process += 1
+        forked_frame = create_frame(second, second.getMessage(), LogtailContext())
+        self.assertEqual(forked_frame['context']['system']['pid'], first.process + 1)
+        self.assertEqual(first_frame['context']['system']['pid'], first.process)
+
+    def test_compact_event_builds_the_same_frame(self):
+        log_record = logging.LogRecord("logtail-test", 20, "/some/path", 10, "Some log message", [], None)
+        log_record.__dict__.update({'data': {'date': datetime.date(2024, 1, 2)}, 'plain': 'value'})
+        context = LogtailContext()
+        with context(customer={'id': 1}):
+            event = create_compact_event(log_record, 'message', context, include_extra_attributes=True)
+            expected = create_frame(log_record, 'message', context, include_extra_attributes=True, serializable=True)
+
+        self.assertFalse(hasattr(event, '__dict__'))
+        self.assertEqual(event.to_frame(), expected)
@@ -1,6 +1,11 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
+import json
 import mock
+import os
+import msgpack
+import shutil
+import tempfile
 import time
 import threading
 import unittest
@@ -8,8 +13,13 @@ import logging
 
 from unittest.mock import patch
 
+import logtail.handler
 from logtail import LogtailHandler, context
-from logtail.handler import FlushWorker
+from logtail.handler import FlushWorker, DEFAULT_BATCH_BYTES
+from logtail.frame import CompactEvent, create_compact_event
+from logtail.flusher import RETRY_SCHEDULE, DEFAULT_RETRY_JITTER, DEFAULT_MAX_RETRY_BYTES, DEFAULT_COALESCE_WINDOW
+
+from .fake_server import FakeIngestServer
 
 class TestLogtailHandler(unittest.TestCase):
     source_token = 'dummy_source_token'
@@ -31,6 +41,16 @@ class TestLogtailHandler(unittest.TestCase):
         handler = LogtailHandler(source_token=self.source_token, host=self.host, timeout=10)
         self.assertEqual(handler.uploader.timeout, 10)
 
+    @patch('logtail.handler.FlushWorker')
+    def test_handler_passes_compression_to_uploader(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, host=self.host)
+        self.assertIsNone(handler.uploader.compression)
+
+        handler = LogtailHandler(source_token=self.source_token, host=self.host, compression='gzip', compression_level=9)
+        self.assertEqual(handler.uploader.compression, 'gzip')
+        self.assertEqual(handler.uploader.compression_level, 9)
+        self.assertEqual(handler.uploader.headers['Content-Encoding'], 'gzip')
+
     @patch('logtail.handler.FlushWorker')
     def test_handler_creates_pipe_from_args(self, MockWorker):
         buffer_capacity = 9
@@ -62,6 +82,19 @@ class TestLogtailHandler(unittest.TestCase):
             buffer_capacity,
             flush_interval,
             check_interval,
+            prepare=None,
+            new_batch=handler.uploader.new_batch,
+            retry_schedule=RETRY_SCHEDULE,
+            retry_jitter=DEFAULT_RETRY_JITTER,
+            max_retry_bytes=DEFAULT_MAX_RETRY_BYTES,
+            spill=None,
+            batch_bytes=DEFAULT_BATCH_BYTES,
+            encoded=False,
+            coalesce=None,
+            coalesce_window=DEFAULT_COALESCE_WINDOW,
+            stats=handler._stats,
+            warm_up=handler.uploader.warm_up,
+            adaptive=None,
         )
         self.assertEqual(handler.flush_thread.start.call_count, 1)
 
@@ -101,6 +134,134 @@ class TestLogtailHandler(unittest.TestCase):
         self.assertTrue(handler.pipe.empty())
         self.assertEqual(handler.dropcount, 1)
 
+    @patch('logtail.handler.FlushWorker')
+    def test_emit_sheds_low_levels_before_errors(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, buffer_capacity=10)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.setLevel(logging.DEBUG)
+        self.addCleanup(logger.setLevel, logging.NOTSET)
+        logger.addHandler(handler)
+        for _ in range(20):
+            logger.debug('noise')
+        for _ in range(5):
+            logger.info('info')
+        logger.error('the one that matters')
+
+        levels = [handler.pipe.get()['level'] for _ in range(handler.pipe.qsize())]
+        self.assertEqual(levels, ['debug'] * 5 + ['info'] * 2 + ['error'])
+        self.assertEqual(handler.dropcounts, {'debug': 15, 'info': 3})
+        self.assertEqual(handler.dropcount, 18)
+
+    @patch('logtail.handler.FlushWorker')
+    def test_emit_bounds_buffer_by_size(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, max_buffer_bytes=10000)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        for _ in range(10):
+            logger.critical('x' * 2000)
+
+        self.assertEqual(handler.pipe.qsize(), 4)
+        self.assertLessEqual(handler.pipe.nbytes, 10000)
+        self.assertEqual(handler.dropcounts, {'critical': 6})
+
+    @patch('logtail.handler.FlushWorker')
+    def test_emit_counts_extras_and_context_in_the_buffer_size(self, MockWorker):
+        for kwargs in ({}, {'deferred_formatting': True}, {'compact_events': True}):
+            handler = LogtailHandler(source_token=self.source_token, max_buffer_bytes=1024 * 1024, **kwargs)
+            logger = logging.getLogger(__name__)
+            logger.handlers = []
+            logger.addHandler(handler)
+            with context(request={'body': 'x' * 50000}):
+                for _ in range(200):
+                    logger.critical('hello', extra={'data': {'blob': ['y' * 50000]}})
+
+            self.assertEqual(handler.pipe.qsize(), 10)
+            self.assertGreater(handler.pipe.nbytes, 1000000)
+            self.assertLessEqual(handler.pipe.nbytes, 1024 * 1024)
+            self.assertEqual(handler.dropcounts, {'critical': 190})
+
+    @patch('logtail.handler.FlushWorker')
+    def test_reinit_after_fork_starts_over_with_a_new_pipe(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, buffer_capacity=10, workers=2)
+        self.assertIn(handler, logtail.handler._live_handlers)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        logger.critical('hello')
+        pipe = handler.pipe
+        session = handler.uploader.session
+
+        handler._reinit_after_fork()
+
+        self.assertIsNot(handler.pipe, pipe)
+        self.assertTrue(handler.pipe.empty())
+        self.assertEqual(handler.pipe.maxsize, 10)
+        self.assertEqual(handler.flush_threads, [None, None])
+        self.assertIsNot(handler.uploader.session, session)
+
+        logger.critical('goodbye')
+        self.assertEqual(handler.pipe.get()['message'], 'goodbye')
+
+    @patch('logtail.handler.FlushWorker')
+    def test_emit_spills_records_to_disk_if_configured(self, MockWorker):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handler = LogtailHandler(
+            source_token=self.source_token,
+            buffer_capacity=1,
+            spill_directory=directory,
+        )
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        logger.critical('hello')
+        logger.critical('goodbye')
+
+        self.assertEqual(handler.pipe.get()['message'], 'hello')
+        self.assertEqual(handler.dropcount, 0)
+        self.assertEqual(len(handler.spill), 1)
+        self.assertEqual(msgpack.unpackb(handler.spill.get()[0], raw=False)['message'], 'goodbye')
+        self.assertIs(MockWorker.call_args[1]['spill'], handler.spill)
+        handler.spill.close()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is not available')
+    @patch('logtail.handler.FlushWorker')
+    def test_forked_children_spill_to_a_slot_of_their_own(self, MockWorker):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handler = LogtailHandler(source_token=self.source_token, buffer_capacity=2, spill_directory=directory)
+        self.addCleanup(handler.spill.close)
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(10):
+                    logger.info('child %d', i)
+                result = [handler.spill.path, len(handler.spill), handler.dropcount]
+                os.write(write_end, json.dumps(result).encode())
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            output = f.read()
+        os.waitpid(pid, 0)
+
+        path, spilled, dropped = json.loads(output)
+        self.assertNotEqual(path, handler.spill.path)
+        self.assertEqual(spilled, 9)
+        self.assertEqual(dropped, 0)
+        self.assertEqual(len(handler.spill), 0)
+
     @patch('logtail.handler.FlushWorker')
     def test_emit_does_not_drop_records_if_configured(self, MockWorker):
         buffer_capacity = 1
@@ -274,9 +435,238 @@ class TestLogtailHandler(unittest.TestCase):
         log_entry = handler.pipe.get()
 
         self.assertEqual(log_entry['message'], 'hello')
-        self.assertEqual(log_entry['context']['data']['egg']['chicken']['egg'], "<omitted circular reference>")
+        self.assertEqual(log_entry['context']['data']['egg']['chicken'], "<omitted circular reference>")
         self.assertTrue(handler.pipe.empty())
 
 
+    @patch('logtail.handler.FlushWorker')
+    def test_deferred_formatting_builds_frames_on_prepare(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, deferred_formatting=True)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        data = {'items': [1]}
+        with context(customer={'id': 1}):
+            logger.info('hello %s', data, extra={'data': data})
+        data['items'].append(2)
+
+        self.assertEqual(MockWorker.call_args[1]['prepare'], handler._prepare)
+        log_entry = handler._prepare(handler.pipe.get())
+
+        self.assertEqual(log_entry['message'], "hello {'items': [1]}")
+        self.assertEqual(log_entry['data'], {'items': [1]})
+        self.assertEqual(log_entry['context']['customer'], {'id': 1})
+        self.assertEqual(log_entry['level'], 'info')
+        self.assertTrue(handler.pipe.empty())
+
+    @patch('logtail.handler.FlushWorker')
+    def test_all_modes_leave_out_unserializable_requests(self, MockWorker):
+        class WSGIRequest(object):
+            pass
+
+        for kwargs in ({}, {'deferred_formatting': True}, {'compact_events': True}):
+            handler = LogtailHandler(source_token=self.source_token, **kwargs)
+            logger = logging.getLogger(__name__)
+            logger.handlers = []
+            logger.addHandler(handler)
+            logger.info('hello', extra={'request': WSGIRequest(), 'order': {'id': 1}})
+
+            log_entry = handler._prepare(handler.pipe.get())
+            self.assertNotIn('request', log_entry)
+            self.assertEqual(log_entry['order'], {'id': 1})
+
+    @patch('logtail.handler.FlushWorker')
+    def test_compact_events_build_the_same_frames_on_prepare(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, compact_events=True)
+        plain = LogtailHandler(source_token=self.source_token)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        logger.addHandler(plain)
+        data = {'items': [1]}
+        with context(customer={'id': 1}):
+            logger.info('hello %s', data, extra={'data': data})
+        data['items'].append(2)
+
+        self.assertEqual(MockWorker.call_args_list[0][1]['prepare'], handler._prepare)
+        entry = handler.pipe.get()
+        self.assertIsInstance(entry, CompactEvent)
+        log_entry = handler._prepare(entry)
+        self.assertEqual(log_entry, plain.pipe.get())
+        self.assertEqual(log_entry['data'], {'items': [1]})
+        self.assertEqual(log_entry['context']['customer'], {'id': 1})
+
+    @patch('logtail.handler.FlushWorker')
+    def test_encoded_events_are_queued_as_msgpack(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, encoded_events=True)
+        plain = LogtailHandler(source_token=self.source_token)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        logger.addHandler(plain)
+        with context(customer={'id': 1}):
+            logger.info('hello')
+
+        kwargs = MockWorker.call_args_list[0][1]
+        self.assertIsNone(kwargs['prepare'])
+        self.assertTrue(kwargs['encoded'])
+        entry = handler.pipe.get()
+        self.assertEqual(msgpack.unpackb(entry, raw=False), plain.pipe.get())
+        self.assertEqual(handler.pipe.nbytes, 0)
+
+    @patch('logtail.handler.FlushWorker')
+    def test_coalesces_repeats_of_the_same_message_template(self, MockWorker):
+        for kwargs in ({}, {'deferred_formatting': True}):
+            handler = LogtailHandler(source_token=self.source_token, coalesce=True, **kwargs)
+            logger = logging.getLogger(__name__)
+            logger.handlers = []
+            logger.addHandler(handler)
+            for attempt in range(3):
+                logger.warning('Retrying request, attempt %d', attempt)
+            logger.error('Retrying request, attempt %d', 3)
+
+            worker_kwargs = MockWorker.call_args[1]
+            fw = FlushWorker(mock.Mock(), handler.pipe, 10, 0.1, 0.01, prepare=worker_kwargs['prepare'],
+                             coalesce=worker_kwargs['coalesce'])
+            fw.parent_thread = mock.MagicMock(is_alive=lambda: False)
+            frame = []
+            fw.upload = lambda batch: frame.extend(batch) or mock.Mock(status_code=202)
+            fw.step()
+
+            self.assertEqual([(e['message'], e.get('repeat_count')) for e in frame], [
+                ('Retrying request, attempt 0', 3),
+                ('Retrying request, attempt 3', None),
+            ])
+            self.assertLessEqual(frame[0]['first_dt'], frame[0]['last_dt'])
+
+    def test_queued_event_modes_are_exclusive(self):
+        with self.assertRaises(ValueError):
+            LogtailHandler(source_token=self.source_token, compact_events=True, encoded_events=True)
+        with self.assertRaises(ValueError):
+            LogtailHandler(source_token=self.source_token, coalesce=True, encoded_events=True)
+
+    @patch('logtail.handler.FlushWorker')
+    def test_deferred_formatting_drops_frames_that_fail_to_build(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, deferred_formatting=True)
+        handler.setFormatter(mock.Mock(format=mock.Mock(side_effect=ValueError)))
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        logger.info('hello')
+
+        self.assertIsNone(handler._prepare(handler.pipe.get()))
+        self.assertEqual(handler.dropcount, 1)
+
+
+    def test_compact_events_drop_only_the_event_whose_context_fails_to_convert(self):
+        class Unprintable(object):
+            def __str__(self):
+                raise ValueError('no')
+
+        for kwargs in ({'compact_events': True}, {'coalesce': True}):
+            with FakeIngestServer() as server:
+                handler = LogtailHandler(source_token=self.source_token, host=server.url, **kwargs)
+                logger = logging.getLogger(__name__)
+                logger.handlers = []
+                logger.addHandler(handler)
+                logger.info('before')
+                with context(data={'obj': Unprintable()}):
+                    logger.info('bad')
+                logger.info('after')
+                handler.flush()
+
+            self.assertEqual(sorted(e['message'] for e in server.events), ['after', 'before'])
+            self.assertEqual(handler.dropcounts, {'info': 1})
+            self.assertTrue(handler.flush_thread.is_alive())
+
+            # Contexts are measured on the logging thread, so failing ones
+            # are usually dropped by `emit`; those that get through are
+            # dropped when prepared.
+            record = logging.LogRecord(__name__, logging.INFO, __file__, 1, 'bad', None, None)
+            with context(data={'obj': Unprintable()}):
+                event = create_compact_event(record, 'bad', context)
+            self.assertIsNone(handler._prepare(event))
+            self.assertEqual(handler.dropcounts, {'info': 2})
+
+    @patch('logtail.handler.FlushWorker')
+    def test_handler_starts_and_restarts_all_workers(self, MockWorker):
+        MockWorker.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        handler = LogtailHandler(source_token=self.source_token, workers=3)
+        self.assertIsNone(handler.flush_thread)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        logger.critical('hello')
+
+        self.assertEqual(MockWorker.call_count, 3)
+        self.assertEqual(len(set(map(id, handler.flush_threads))), 3)
+        self.assertIs(handler.flush_thread, handler.flush_threads[0])
+
+        handler.flush_threads[1].is_alive = mock.Mock(return_value=False)
+        logger.critical('hello')
+        self.assertEqual(MockWorker.call_count, 4)
+
+        handler.flush()
+        for flush_thread in handler.flush_threads:
+            self.assertEqual(flush_thread.flush.call_count, 1)
+
+    def test_handler_rejects_invalid_worker_count(self):
+        with self.assertRaises(ValueError):
+            LogtailHandler(source_token=self.source_token, workers=0)
+
+    def test_connection_pool_fits_all_workers(self):
+        handler = LogtailHandler(source_token=self.source_token, workers=16)
+        self.assertEqual(handler.uploader.pool_size, 16)
+        handler = LogtailHandler(source_token=self.source_token, pool_size=2)
+        self.assertEqual(handler.uploader.pool_size, 2)
+
+    @patch('logtail.handler.HTTP2Uploader')
+    def test_http2_uses_http2_uploader(self, MockUploader):
+        handler = LogtailHandler(source_token=self.source_token, http2=True)
+        self.assertIs(handler.uploader, MockUploader.return_value)
+
+    @patch('logtail.handler.FlushWorker')
+    def test_adaptive_gives_each_worker_its_own_limits(self, MockWorker):
+        handler = LogtailHandler(source_token=self.source_token, buffer_capacity=100, flush_interval=2,
+                                 workers=2, adaptive=True)
+        handler.ensure_flush_thread_alive()
+        first, second = (c[1]['adaptive'] for c in MockWorker.call_args_list)
+        self.assertIsNot(first, second)
+        self.assertEqual((first.min_capacity, first.max_capacity, first.max_interval), (100, 1000, 2))
+
+    def test_workers_upload_batches_concurrently(self):
+        num_events = 24
+
+        def ship(workers):
+            with FakeIngestServer(latency=0.05) as server:
+                handler = LogtailHandler(
+                    source_token=self.source_token,
+                    host=server.url,
+                    buffer_capacity=2,
+                    drop_extra_events=False,
+                    check_interval=0.01,
+                    workers=workers,
+                )
+                logger = logging.getLogger(__name__)
+                logger.handlers = []
+                logger.addHandler(handler)
+
+                start = time.time()
+                for i in range(num_events):
+                    logger.critical('event %d', i)
+                handler.flush()
+                elapsed = time.time() - start
+
+                self.assertEqual(sorted(e['message'] for e in server.events), sorted('event %d' % i for i in range(num_events)))
+                return elapsed
+
+        self.assertLess(ship(workers=4), ship(workers=1) / 2)
+
+
 class UnserializableObject(object):
     """ Because this is a custom class, it cannot be serialized into JSON. """
@@ -1,8 +1,12 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
+import asyncio
+import logging
+import threading
 import unittest
 
 from logtail import LogtailContext
+from logtail.frame import create_frame
 
 
 class TestLogtailContext(unittest.TestCase):
@@ -32,6 +36,7 @@ class TestLogtailContext(unittest.TestCase):
         with self.assertRaises(ValueError):
             with c(user={'name': 'a'}):
                 raise ValueError('should be thrown')
+        self.assertFalse(c.exists())
 
     def test_nested_collapse(self):
         c = LogtailContext()
@@ -56,3 +61,123 @@ class TestLogtailContext(unittest.TestCase):
             )
 
         self.assertEqual(c.collapse(), {})
+
+    def test_snapshot_is_not_affected_by_later_changes(self):
+        c = LogtailContext()
+        self.assertFalse(c.snapshot().exists())
+
+        with c(user={'name': 'a'}):
+            snapshot = c.snapshot()
+            with c(user={'name': 'b'}):
+                pass
+        self.assertFalse(c.exists())
+        self.assertEqual(snapshot.collapse(), {'user': {'name': 'a'}})
+
+    def test_collapse_is_cached_until_the_context_changes(self):
+        c = LogtailContext()
+        with c(user={'name': 'a'}):
+            collapsed = c.collapse()
+            self.assertIs(c.collapse(), collapsed)
+            self.assertIs(c.snapshot().collapse(), collapsed)
+
+            with c(user={'name': 'b'}):
+                self.assertEqual(c.collapse(), {'user': {'name': 'b'}})
+            # Leaving a context goes back to the outer one's collapsed view.
+            self.assertIs(c.collapse(), collapsed)
+        self.assertEqual(collapsed, {'user': {'name': 'a'}})
+
+    def test_contexts_are_copied_when_entered(self):
+        c = LogtailContext()
+        request = {'id': 1, 'tags': ['a']}
+        with c(request=request):
+            request['user'] = 'bob'
+            request['tags'].append('b')
+            self.assertEqual(c.collapse(), {'request': {'id': 1, 'tags': ['a']}})
+
+    def test_frames_carry_contexts_as_they_were_entered(self):
+        c = LogtailContext()
+        request = {'id': 1}
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'hello', None, None)
+        with c(request=request):
+            first = create_frame(record, 'hello', c)
+            request['user'] = 'bob'
+            second = create_frame(record, 'hello', c)
+        self.assertEqual(first['context']['request'], {'id': 1})
+        self.assertEqual(second['context']['request'], {'id': 1})
+
+    def test_extras_lists_contexts_outermost_first(self):
+        c = LogtailContext()
+        with c(user={'name': 'a'}):
+            with c(request={'id': 1}):
+                self.assertEqual(c.extras, [{'user': {'name': 'a'}}, {'request': {'id': 1}}])
+        self.assertEqual(c.extras, [])
+
+    def test_contexts_are_local_to_threads(self):
+        c = LogtailContext()
+        entered = threading.Event()
+        release = threading.Event()
+        seen = []
+
+        def worker():
+            with c(user={'name': 'b'}):
+                entered.set()
+                release.wait(5)
+                seen.append(c.collapse())
+
+        with c(user={'name': 'a'}):
+            t = threading.Thread(target=worker)
+            t.start()
+            entered.wait(5)
+            self.assertEqual(c.collapse(), {'user': {'name': 'a'}})
+            release.set()
+            t.join(5)
+            self.assertEqual(c.collapse(), {'user': {'name': 'a'}})
+        self.assertEqual(seen, [{'user': {'name': 'b'}}])
+
+    def test_contexts_are_local_to_asyncio_tasks(self):
+        c = LogtailContext()
+
+        async def request(i):
+            with c(request={'id': i}):
+                await asyncio.sleep(0.01)
+                return c.collapse()
+
+        async def main():
+            with c(app={'name': 'shop'}):
+                return await asyncio.gather(*(request(i) for i in range(5)))
+
+        results = asyncio.run(main())
+        self.assertEqual(results, [{'app': {'name': 'shop'}, 'request': {'id': i}} for i in range(5)])
+        self.assertFalse(c.exists())
+
+    def test_global_contexts_are_seen_by_every_thread(self):
+        c = LogtailContext()
+        c.global_context(app={'name': 'shop'})
+        seen = []
+
+        def worker():
+            with c(request={'id': 1}):
+                seen.append(c.collapse())
+            seen.append(c.collapse())
+
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join(5)
+        self.assertEqual(seen, [
+            {'app': {'name': 'shop'}, 'request': {'id': 1}},
+            {'app': {'name': 'shop'}},
+        ])
+        self.assertTrue(c.exists())
+        self.assertEqual(c.extras, [{'app': {'name': 'shop'}}])
+
+    def test_global_contexts_are_merged_under_entered_ones(self):
+        c = LogtailContext()
+        c.global_context(app={'name': 'shop', 'version': 1})
+        with c(app={'version': 2}):
+            collapsed = c.collapse()
+            self.assertEqual(collapsed, {'app': {'name': 'shop', 'version': 2}})
+            snapshot = c.snapshot()
+            # Collapsed views are rebuilt when the global contexts change.
+            c.global_context(host={'name': 'a'})
+            self.assertEqual(c.collapse(), {'app': {'name': 'shop', 'version': 2}, 'host': {'name': 'a'}})
+            self.assertEqual(snapshot.collapse(), collapsed)
@@ -0,0 +1,87 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import threading
+import time
+import unittest
+
+from logtail.compat import queue
+from logtail.pipe import Pipe
+
+
+class TestPipe(unittest.TestCase):
+    def test_behaves_like_a_queue(self):
+        pipe = Pipe(maxsize=2)
+        pipe.put(1)
+        pipe.put(2)
+        self.assertTrue(pipe.full())
+        with self.assertRaises(queue.Full):
+            pipe.put(3, block=False)
+        self.assertEqual(pipe.get(), 1)
+        self.assertEqual(pipe.get(block=False), 2)
+        with self.assertRaises(queue.Empty):
+            pipe.get(block=False)
+        with self.assertRaises(queue.Empty):
+            pipe.get(timeout=0.01)
+
+    def test_bounds_items_by_size(self):
+        pipe = Pipe(max_bytes=100)
+        pipe.put('a', nbytes=60)
+        with self.assertRaises(queue.Full):
+            pipe.put('b', block=False, nbytes=60)
+        pipe.put('c', block=False, nbytes=40)
+        self.assertEqual(pipe.nbytes, 100)
+
+        self.assertEqual(pipe.get(), 'a')
+        self.assertEqual(pipe.nbytes, 40)
+        pipe.put('b', block=False, nbytes=60)
+
+    def test_admits_oversized_items_into_an_empty_pipe(self):
+        pipe = Pipe(max_bytes=100)
+        pipe.put('a', block=False, nbytes=500)
+        self.assertEqual(pipe.get(), 'a')
+
+    def test_keeps_room_for_items_with_a_larger_share(self):
+        pipe = Pipe(maxsize=4)
+        pipe.put('debug 1', block=False, share=0.5)
+        pipe.put('debug 2', block=False, share=0.5)
+        with self.assertRaises(queue.Full):
+            pipe.put('debug 3', block=False, share=0.5)
+        pipe.put('error 1', block=False)
+        pipe.put('error 2', block=False)
+        self.assertTrue(pipe.full())
+
+    def test_wake_interrupts_blocked_get(self):
+        pipe = Pipe()
+        result = []
+
+        def consumer():
+            start = time.time()
+            try:
+                pipe.get(timeout=10)
+            except queue.Empty:
+                result.append(time.time() - start)
+
+        t = threading.Thread(target=consumer)
+        t.start()
+        time.sleep(0.05)
+        pipe.wake()
+        t.join(1)
+
+        self.assertFalse(t.is_alive())
+        self.assertLess(result[0], 1)
+
+    def test_get_returns_items_put_after_a_wakeup(self):
+        pipe = Pipe()
+        pipe.wake()
+        pipe.put('item')
+        self.assertEqual(pipe.get(timeout=1), 'item')
+
+    def test_wake_without_blocked_get_interrupts_the_next_one(self):
+        pipe = Pipe()
+        pipe.wake()
+        start = time.time()
+        with self.assertRaises(queue.Empty):
+            pipe.get(timeout=10)
+        self.assertLess(time.time() - start, 1)
+        with self.assertRaises(queue.Empty):
+            pipe.get(timeout=0.01)
@@ -0,0 +1,101 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import logging
+import unittest
+
+import mock
+
+from logtail import LogtailHandler, Sampler
+
+
+def make_record(name='app', level=logging.INFO, lineno=1):
+    return logging.LogRecord(name, level, '/srv/app.py', lineno, 'hello', None, None)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSampler(unittest.TestCase):
+    def test_keeps_everything_by_default(self):
+        sampler = Sampler()
+        self.assertTrue(all(sampler.allow(make_record()) for _ in range(100)))
+
+    def test_applies_logger_ratios_to_child_loggers(self):
+        sampler = Sampler(logger_ratios={'app.db': 0.25}, rng=lambda: 0.5)
+        self.assertFalse(sampler.allow(make_record('app.db')))
+        self.assertFalse(sampler.allow(make_record('app.db.pool')))
+        self.assertTrue(sampler.allow(make_record('app.dbx')))
+        self.assertTrue(sampler.allow(make_record('app')))
+
+    def test_combines_logger_and_level_ratios(self):
+        sampler = Sampler(logger_ratios={'app': 0.5}, level_ratios={logging.DEBUG: 0.5, logging.INFO: 1.0}, rng=lambda: 0.3)
+        self.assertFalse(sampler.allow(make_record('app', logging.DEBUG)))
+        self.assertTrue(sampler.allow(make_record('app', logging.INFO)))
+        self.assertTrue(sampler.allow(make_record('other', logging.DEBUG)))
+
+    def test_always_keeps_errors(self):
+        sampler = Sampler(logger_ratios={'app': 0}, rate=1, burst=1)
+        self.assertTrue(all(sampler.allow(make_record(level=logging.ERROR)) for _ in range(10)))
+        self.assertFalse(sampler.allow(make_record(level=logging.WARNING)))
+
+    def test_rate_limits_each_call_site(self):
+        clock = FakeClock()
+        sampler = Sampler(rate=2, burst=3, clock=clock)
+        self.assertEqual([sampler.allow(make_record(lineno=1)) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(sampler.allow(make_record(lineno=2)))
+
+        clock.now += 0.5
+        self.assertEqual([sampler.allow(make_record(lineno=1)) for _ in range(2)], [True, False])
+
+    def test_summarizes_suppressed_records_per_window(self):
+        clock = FakeClock()
+        sampler = Sampler(logger_ratios={'app.db': 0}, rate=1, burst=1, summary_interval=10, clock=clock)
+        sampler.allow(make_record('app.db'))
+        sampler.allow(make_record('app.http'))
+        sampler.allow(make_record('app.http'))
+        self.assertIsNone(sampler.take_summary())
+
+        clock.now = 10
+        summary = sampler.take_summary()
+        self.assertEqual(summary.getMessage(), 'Suppressed 2 log events in the last 10 seconds')
+        self.assertEqual(summary.levelno, logging.WARNING)
+        self.assertEqual(summary.suppressed['sampled'], 1)
+        self.assertEqual(summary.suppressed['rate_limited'], 1)
+        self.assertEqual(summary.suppressed['loggers'], {'app.db': 1, 'app.http': 1})
+
+        clock.now = 20
+        self.assertIsNone(sampler.take_summary())
+
+    def test_rejects_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            Sampler(rate=0)
+
+
+class TestLogtailHandlerSampling(unittest.TestCase):
+    @mock.patch('logtail.handler.FlushWorker')
+    def test_suppressed_records_are_not_queued(self, MockWorker):
+        clock = FakeClock()
+        sampler = Sampler(rate=1, burst=2, summary_interval=60, clock=clock)
+        handler = LogtailHandler(source_token='dummy_source_token', sampler=sampler)
+        handler.format = mock.Mock(wraps=handler.format)
+
+        logger = logging.getLogger(__name__)
+        logger.handlers = []
+        logger.addHandler(handler)
+        for _ in range(5):
+            logger.info('hot loop')
+        logger.error('failed')
+        self.assertEqual(handler.format.call_count, 3)
+
+        clock.now = 60
+        logger.info('after a minute')
+        messages = [handler.pipe.get()['message'] for _ in range(handler.pipe.qsize())]
+        self.assertEqual(messages, [
+            'hot loop', 'hot loop', 'failed',
+            'Suppressed 3 log events in the last 60 seconds', 'after a minute',
+        ])
@@ -0,0 +1,70 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from logtail import LogtailHandler, Shipper
+from logtail.shipper import _UnixStreamServer
+from logtail.uploader import SocketUploader
+
+from .fake_server import FakeIngestServer
+
+
+@unittest.skipIf(_UnixStreamServer is None, 'Unix sockets are not available')
+class TestShipper(unittest.TestCase):
+    source_token = 'dummy_source_token'
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.address = os.path.join(directory, 'logtail.sock')
+
+    def _wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_uploads_events_of_all_handlers_together(self):
+        with FakeIngestServer() as server:
+            shipper = Shipper(self.source_token, self.address, host=server.url, flush_interval=0.05)
+            shipper.start()
+            self.addCleanup(shipper.close)
+
+            # Stand-ins for the handlers of two worker processes.
+            for name in ('first', 'second'):
+                handler = LogtailHandler(source_token=self.source_token, shipper_address=self.address)
+                logger = logging.getLogger('%s.%s' % (__name__, name))
+                logger.handlers = []
+                logger.propagate = False
+                logger.addHandler(handler)
+                for i in range(3):
+                    logger.critical('%s %d', name, i)
+                handler.flush()
+
+            self._wait_for(lambda: len(server.events) == 6)
+
+        self.assertEqual(
+            sorted(e['message'] for e in server.events),
+            ['first 0', 'first 1', 'first 2', 'second 0', 'second 1', 'second 2'],
+        )
+        self.assertEqual(server.events[0]['context']['runtime']['logger_name'], __name__ + '.first')
+
+    def test_close_removes_socket(self):
+        shipper = Shipper(self.source_token, self.address)
+        shipper.start()
+        self.assertTrue(os.path.exists(self.address))
+        shipper.close()
+        self.assertFalse(os.path.exists(self.address))
+        for flush_thread in shipper.flush_threads:
+            flush_thread.join(1)
+            self.assertFalse(flush_thread.is_alive())
+
+    def test_socket_uploader_fails_without_shipper(self):
+        uploader = SocketUploader(self.address)
+        response = uploader([{'message': 'hello'}])
+        self.assertEqual(response.status_code, 500)
+        self.assertIsInstance(response.exception, OSError)
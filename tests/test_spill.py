@@ -0,0 +1,142 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from logtail.spill import SpillQueue
+
+
+class TestSpillQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get(self, spill):
+        # Takes the next event out for good, as once its batch is uploaded.
+        got = spill.get()
+        if got is None:
+            return None
+        data, receipt = got
+        spill.ack([receipt])
+        return data
+
+    def _segments(self, slot=0):
+        return sorted(n for n in os.listdir(os.path.join(self.directory, 'slot-%d' % slot)) if n != 'lock')
+
+    def test_returns_events_in_order(self):
+        spill = SpillQueue(self.directory)
+        self.assertTrue(spill.empty())
+        self.assertIsNone(self._get(spill))
+
+        for i in range(10):
+            spill.put(b'event %d' % i)
+        self.assertEqual(len(spill), 10)
+
+        self.assertEqual([self._get(spill) for _ in range(10)], [b'event %d' % i for i in range(10)])
+        self.assertTrue(spill.empty())
+        self.assertIsNone(self._get(spill))
+        spill.close()
+
+    def test_rolls_over_and_deletes_drained_segments(self):
+        spill = SpillQueue(self.directory, segment_bytes=64)
+        for i in range(10):
+            spill.put(b'x' * 20)
+        self.assertEqual(len(self._segments()), 5)
+
+        for i in range(10):
+            self.assertEqual(self._get(spill), b'x' * 20)
+        self.assertIsNone(self._get(spill))
+        self.assertEqual(len(self._segments()), 1)
+        spill.close()
+
+    def test_stores_events_larger_than_a_segment(self):
+        spill = SpillQueue(self.directory, segment_bytes=16)
+        spill.put(b'y' * 100)
+        spill.put(b'z')
+        self.assertEqual(self._get(spill), b'y' * 100)
+        self.assertEqual(self._get(spill), b'z')
+        spill.close()
+
+    def test_replays_unconsumed_events_after_restart(self):
+        spill = SpillQueue(self.directory, segment_bytes=64)
+        for i in range(6):
+            spill.put(b'event %d' % i)
+        self.assertEqual(self._get(spill), b'event 0')
+        spill.close()
+
+        spill = SpillQueue(self.directory, segment_bytes=64)
+        self.assertEqual(len(spill), 5)
+        spill.put(b'event 6')
+        self.assertEqual([self._get(spill) for _ in range(6)], [b'event %d' % i for i in range(1, 7)])
+        self.assertIsNone(self._get(spill))
+        spill.close()
+
+    def test_evicts_oldest_segments_over_max_bytes(self):
+        spill = SpillQueue(self.directory, segment_bytes=64, max_bytes=128)
+        for i in range(8):
+            spill.put(b'event %02d' % i + b'.' * 16)
+
+        self.assertLessEqual(spill.nbytes, 128)
+        self.assertEqual(spill.dropcount, 4)
+        self.assertEqual(len(spill), 4)
+        self.assertEqual(self._get(spill)[:8], b'event 04')
+        spill.close()
+
+    def test_queues_sharing_a_directory_use_their_own_slots(self):
+        a = SpillQueue(self.directory)
+        b = SpillQueue(self.directory)
+        self.assertNotEqual(a.path, b.path)
+        a.put(b'a1')
+        b.put(b'b1')
+        a.put(b'a2')
+        self.assertEqual([self._get(a), self._get(a), self._get(a)], [b'a1', b'a2', None])
+        self.assertEqual([self._get(b), self._get(b)], [b'b1', None])
+        a.close()
+        b.close()
+
+    def test_leftover_slots_are_replayed_once(self):
+        a = SpillQueue(self.directory)
+        b = SpillQueue(self.directory)
+        a.put(b'a1')
+        b.put(b'b1')
+        a.close()
+        b.close()
+
+        # Each restarted queue takes over one of the slots.
+        a = SpillQueue(self.directory)
+        b = SpillQueue(self.directory)
+        self.assertEqual(sorted([self._get(a), self._get(b)]), [b'a1', b'b1'])
+        self.assertTrue(a.empty() and b.empty())
+        a.close()
+        b.close()
+
+    def test_replays_events_not_acknowledged_after_restart(self):
+        spill = SpillQueue(self.directory, segment_bytes=64)
+        for i in range(3):
+            spill.put(b'event %d' % i)
+        _, first = spill.get()
+        spill.get()
+        spill.ack([first])
+        self.assertEqual(len(spill), 1)
+        spill.close()
+
+        spill = SpillQueue(self.directory, segment_bytes=64)
+        self.assertEqual(len(spill), 2)
+        self.assertEqual([self._get(spill), self._get(spill)], [b'event 1', b'event 2'])
+        spill.close()
+
+    def test_keeps_drained_segments_until_acknowledged(self):
+        spill = SpillQueue(self.directory, segment_bytes=16)
+        spill.put(b'x' * 10)
+        spill.put(b'y' * 10)
+        _, receipt = spill.get()
+        self.assertEqual(spill.get()[0], b'y' * 10)
+        self.assertEqual(len(self._segments()), 2)
+
+        spill.ack([receipt])
+        self.assertEqual(len(self._segments()), 1)
+        spill.close()
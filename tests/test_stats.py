@@ -0,0 +1,113 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+import logging
+import mock
+import socket
+import unittest
+
+from logtail import LogtailHandler
+from logtail.stats import Histogram, Stats, to_prometheus
+
+from .fake_server import FakeIngestServer
+
+
+class TestStats(unittest.TestCase):
+    def test_histogram_counts_are_cumulative(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.snapshot(), {
+            'buckets': {1: 2, 10: 3, '+Inf': 4},
+            'sum': 56.5,
+            'count': 4,
+        })
+
+    def test_records_shipped_events_and_failures(self):
+        stats = Stats()
+        stats.record_upload([1, 2, 3], 202, 0.02)
+        stats.record_upload([4], 503, 0.5)
+        stats.record_upload([5], 500, 30)
+        snapshot = stats.snapshot()
+
+        self.assertEqual(snapshot['events_shipped'], 3)
+        self.assertEqual(snapshot['failures'], {503: 1, 500: 1})
+        self.assertEqual(snapshot['network_errors'], 0)
+        self.assertEqual(snapshot['batch_size']['count'], 1)
+        self.assertEqual(snapshot['upload_seconds']['count'], 3)
+        self.assertEqual(snapshot['upload_seconds']['buckets']['+Inf'], 3)
+
+    def test_records_bytes_as_sent_and_network_errors(self):
+        stats = Stats()
+        stats.record_upload([1, 2], 202, 0.02, nbytes=10)
+        stats.record_upload([3], 500, 0.02, nbytes=5, error=ConnectionError('refused'))
+        snapshot = stats.snapshot()
+
+        self.assertEqual(snapshot['bytes_shipped'], 10)
+        self.assertEqual(snapshot['network_errors'], 1)
+        self.assertEqual(snapshot['failures'], {})
+
+    def test_to_prometheus(self):
+        text = to_prometheus({
+            'events_shipped': 3,
+            'dropped': {'debug': 2},
+            'failures': {503: 1},
+            'batch_size': Histogram((1,)).snapshot(),
+        })
+        self.assertIn('logtail_handler_events_shipped 3\n', text)
+        self.assertIn('logtail_handler_dropped{level="debug"} 2\n', text)
+        self.assertIn('logtail_handler_failures{status_code="503"} 1\n', text)
+        self.assertIn('logtail_handler_batch_size_bucket{le="+Inf"} 0\n', text)
+        self.assertIn('# TYPE logtail_handler_batch_size histogram\n', text)
+
+
+class TestLogtailHandlerStats(unittest.TestCase):
+    def test_reports_queue_shipping_and_drops(self):
+        with FakeIngestServer() as server:
+            handler = LogtailHandler(source_token='dummy_source_token', host=server.url, buffer_capacity=3)
+            # Nothing takes events out of the pipe until the worker starts.
+            handler.ensure_flush_thread_alive = lambda: None
+            logger = logging.getLogger(__name__)
+            logger.handlers = []
+            logger.addHandler(handler)
+            for i in range(5):
+                logger.critical('event %d', i)
+            del handler.ensure_flush_thread_alive
+            handler.ensure_flush_thread_alive()
+            handler.flush()
+            stats = handler.stats()
+
+        self.assertEqual(stats['events_shipped'], 3)
+        self.assertGreater(stats['bytes_shipped'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['queue_high_water'], 3)
+        self.assertEqual(stats['dropped'], {'critical': 2})
+        self.assertEqual(stats['failures'], {})
+        self.assertEqual(stats['emit_seconds']['count'], 5)
+        self.assertEqual(stats['upload_seconds']['count'], 1)
+
+    def test_reports_compressed_bytes_and_network_errors(self):
+        with FakeIngestServer() as server:
+            handler = LogtailHandler(source_token='dummy_source_token', host=server.url, compression='gzip')
+            logger = logging.getLogger(__name__)
+            logger.handlers = []
+            logger.addHandler(handler)
+            for i in range(100):
+                logger.critical('event %d', i)
+            handler.flush()
+            stats = handler.stats()
+        self.assertEqual(stats['bytes_shipped'], server.bytes)
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        handler = LogtailHandler(source_token='dummy_source_token', host=url, retry_schedule=(), warm_up=False)
+        logger.handlers = []
+        logger.addHandler(handler)
+        with mock.patch('builtins.print'):
+            logger.critical('lost')
+            handler.flush()
+        stats = handler.stats()
+        self.assertEqual(stats['network_errors'], 1)
+        self.assertEqual(stats['failures'], {})
+        self.assertEqual(stats['bytes_shipped'], 0)
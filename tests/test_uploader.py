@@ -1,12 +1,18 @@
 # coding: utf-8
 from __future__ import print_function, unicode_literals
+import gzip
 import msgpack
 import mock
+import requests
+import socket
 import unittest
 
 from unittest.mock import patch
 
-from logtail.uploader import Uploader
+from logtail.compat import httpx, zstd_compress
+from logtail.uploader import Uploader, HTTP2Uploader, TRUNCATED_SUFFIX, _forget_shared_sessions
+
+from .fake_server import FakeIngestServer
 
 
 class TestUploader(unittest.TestCase):
@@ -34,3 +40,149 @@ class TestUploader(unittest.TestCase):
         u(self.frame)
 
         self.assertTrue(post.called)
+
+    @patch('logtail.uploader.requests.Session.post')
+    def test_call_with_batch(self, post):
+        u = Uploader(self.source_token, self.host, self.timeout)
+        batch = u.new_batch()
+        for event in self.frame:
+            batch.append({'message': event})
+
+        self.assertEqual(len(batch), len(self.frame))
+        self.assertEqual(batch.nbytes, len(b''.join(msgpack.packb({'message': e}) for e in self.frame)))
+
+        u(batch)
+        data = post.call_args[1]['data']
+        self.assertEqual(msgpack.unpackb(data, raw=False), [{'message': e} for e in self.frame])
+
+    def test_new_batch_reuses_packer_per_thread(self):
+        u = Uploader(self.source_token, self.host, self.timeout)
+        self.assertIs(u.new_batch()._packer, u.new_batch()._packer)
+
+    def test_truncates_long_messages_of_oversized_events(self):
+        u = Uploader(self.source_token, self.host, self.timeout, max_event_bytes=200)
+        event = {'message': 'x' * 1000, 'user': 'alice', 'context': {'runtime': {'line': 1}}}
+        data = u.encode(event)
+
+        self.assertLessEqual(len(data), 200)
+        truncated = msgpack.unpackb(data, raw=False)
+        self.assertTrue(truncated['message'].endswith(TRUNCATED_SUFFIX))
+        self.assertEqual(truncated['user'], 'alice')
+        self.assertEqual(truncated['context'], event['context'])
+        self.assertTrue(truncated['logtail_truncated'])
+        self.assertEqual(len(event['message']), 1000)
+
+    def test_drops_large_custom_fields_of_oversized_events(self):
+        u = Uploader(self.source_token, self.host, self.timeout, max_event_bytes=200)
+        event = {
+            'message': 'hello',
+            'payload': list(range(1000)),
+            'context': {'runtime': {'line': 1}, 'request': {'body': 'y' * 1000}},
+        }
+        batch = u.new_batch()
+        batch.append(event)
+
+        self.assertLessEqual(batch.nbytes, 200)
+        truncated = msgpack.unpackb(batch.payload(), raw=False)[0]
+        self.assertEqual(truncated['message'], 'hello')
+        self.assertNotIn('payload', truncated)
+        self.assertEqual(truncated['context'], {'runtime': {'line': 1}})
+        self.assertIn('request', event['context'])
+
+    def test_keeps_events_within_max_event_bytes(self):
+        u = Uploader(self.source_token, self.host, self.timeout, max_event_bytes=200)
+        event = {'message': 'hello', 'context': {}}
+        self.assertEqual(msgpack.unpackb(u.encode(event), raw=False), event)
+
+    @patch('logtail.uploader.requests.Session.post')
+    def test_call_with_gzip_compression(self, post):
+        u = Uploader(self.source_token, self.host, self.timeout, compression='gzip', compression_level=1)
+        u(self.frame)
+
+        kwargs = post.call_args[1]
+        self.assertEqual(kwargs['headers'].get('Content-Encoding'), 'gzip')
+        self.assertEqual(kwargs['headers'].get('Content-Type'), 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(gzip.decompress(kwargs['data']), raw=False), self.frame)
+
+    @unittest.skipIf(zstd_compress is None, 'zstd is not available')
+    @patch('logtail.uploader.requests.Session.post')
+    def test_call_with_zstd_compression(self, post):
+        u = Uploader(self.source_token, self.host, self.timeout, compression='zstd')
+        u(self.frame)
+
+        kwargs = post.call_args[1]
+        self.assertEqual(kwargs['headers'].get('Content-Encoding'), 'zstd')
+        self.assertTrue(kwargs['data'].startswith(b'\x28\xb5\x2f\xfd'))
+
+    def test_rejects_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            Uploader(self.source_token, self.host, self.timeout, compression='brotli')
+
+    @patch('logtail.uploader.requests.Session.post')
+    def test_call_without_compression(self, post):
+        u = Uploader(self.source_token, self.host, self.timeout)
+        u(self.frame)
+        self.assertNotIn('Content-Encoding', post.call_args[1]['headers'])
+
+    def test_mounts_pool_with_keepalive(self):
+        u = Uploader(self.source_token, self.host, self.timeout, pool_size=4)
+        adapter = u.session.get_adapter(self.host)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), adapter.poolmanager.connection_pool_kw['socket_options'])
+
+        u = Uploader(self.source_token, self.host, self.timeout, keepalive=False)
+        adapter = u.session.get_adapter(self.host)
+        self.assertNotIn('socket_options', adapter.poolmanager.connection_pool_kw)
+
+    def test_shares_session_between_uploaders_to_the_same_host(self):
+        self.addCleanup(_forget_shared_sessions)
+        first = Uploader(self.source_token, self.host, self.timeout, share_session=True)
+        second = Uploader('other token', self.host, self.timeout, share_session=True)
+        other_host = Uploader(self.source_token, 'https://example.com', self.timeout, share_session=True)
+        unshared = Uploader(self.source_token, self.host, self.timeout)
+        self.assertIs(first.session, second.session)
+        self.assertIsNot(first.session, other_host.session)
+        self.assertIsNot(first.session, unshared.session)
+
+        _forget_shared_sessions()
+        first._reset_after_fork()
+        self.assertIsNot(first.session, second.session)
+
+    @patch('logtail.uploader.requests.Session.head')
+    def test_warm_up_ignores_connection_errors(self, head):
+        head.side_effect = requests.ConnectionError('refused')
+        u = Uploader(self.source_token, self.host, self.timeout)
+        u.warm_up()
+        head.assert_called_once_with(self.host, timeout=self.timeout)
+
+    @patch('logtail.uploader.httpx', None)
+    def test_http2_requires_httpx(self):
+        with self.assertRaises(ImportError):
+            HTTP2Uploader(self.source_token, self.host, self.timeout)
+
+    @unittest.skipIf(httpx is None, 'httpx is not available')
+    def test_http2_posts_batches(self):
+        with patch('logtail.uploader.httpx.HTTPTransport', wraps=httpx.HTTPTransport) as transport:
+            u = HTTP2Uploader(self.source_token, self.host, self.timeout, pool_size=4)
+        kwargs = transport.call_args[1]
+        self.assertTrue(kwargs['http2'])
+        self.assertEqual(kwargs['limits'].max_connections, 4)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), kwargs['socket_options'])
+
+        # Without TLS there is no HTTP/2 negotiation, so the fake server is
+        # spoken to over HTTP/1.1 through the same client.
+        with FakeIngestServer() as server:
+            u = HTTP2Uploader(self.source_token, server.url, self.timeout)
+            response = u(self.frame)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(server.events, self.frame)
+
+    @unittest.skipIf(httpx is None, 'httpx is not available')
+    def test_http2_turns_connection_errors_into_500s(self):
+        def refuse(request):
+            raise httpx.ConnectError('refused', request=request)
+
+        u = HTTP2Uploader(self.source_token, self.host, self.timeout)
+        u.session = httpx.Client(transport=httpx.MockTransport(refuse))
+        u.warm_up()
+        self.assertEqual(u(self.frame).status_code, 500)